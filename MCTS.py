@@ -1,33 +1,107 @@
 import gc
 import math
-import copy
 import random
 import numpy as np
 
 import utils
 import board
-from model import *
+import evaluation_cache
 from config import *
 
 
+"""
+Two interchangeable tree stores are available:
+    'edges':  Node with a list of Edge objects, each holding a `stats` dict
+    'arrays': ArrayNode, keeping the statistics of all children in NumPy arrays
+MCTS only talks to the nodes through expand/select/child/update, so the store
+is chosen by the type of the root node (see make_node).
+"""
+
+
 class Node:
     def __init__(self, state, currPlayer):
         self.state = state
         self.currPlayer = currPlayer
         self.edges = []
-        self.pi = np.zeros(NUM_CHECKERS * BOARD_WIDTH * BOARD_HEIGHT, dtype='float64')
+        self.pi = None          # Set on the root by MCTS.search
 
     def isLeaf(self):
         return len(self.edges) == 0
-    
+
     def nextPlayer(self):
         self.currPlayer = (self.currPlayer % 6) + 1  # Cycle through six players
 
+    def expand(self, moves, priors):
+        for (fromPos, toPos), prior in zip(moves, priors):
+            self.edges.append(Edge(self, None, prior, fromPos, toPos))
+
+    def select(self, cpuct):
+        maxQU = float('-inf')
+        chosen_edges = []
+        N_sum = 0
+
+        for edge in self.edges:
+            N_sum += edge.stats['N']
+
+        for i, edge in enumerate(self.edges):
+            U = cpuct * edge.stats['P'] * np.sqrt(N_sum) / (1. + edge.stats['N'])
+            QU = edge.stats['Q'] + U
+
+            if QU > maxQU:
+                maxQU = QU
+                chosen_edges = [i]
+            elif math.fabs(QU - maxQU) < EPSILON:
+                chosen_edges.append(i)
+
+        # Choose a random node to continue simulation
+        return random.choice(chosen_edges)
+
+    def child(self, index, table=None):
+        edge = self.edges[index]
+        if edge._outNode is None:
+            edge._outNode = build_child(self, edge.fromPos, edge.toPos, table)
+        return edge._outNode
+
+    def edge(self, index):
+        return self.edges[index]
+
+    def update(self, index, value):
+        stats = self.edges[index].stats
+        stats['N'] += 1
+        stats['W'] += value
+        stats['Q'] = stats['W'] / float(stats['N'])    # Use float() for python2 compatibility
+
+    def virtualLoss(self, index, loss):
+        stats = self.edges[index].stats
+        stats['N'] += loss
+        stats['W'] -= loss
+        stats['Q'] = stats['W'] / float(stats['N']) if stats['N'] else 0
+
+    def moves(self):
+        return [(edge.fromPos, edge.toPos) for edge in self.edges]
+
+    def findChild(self, fromPos, toPos):
+        for i, edge in enumerate(self.edges):
+            if edge.fromPos == fromPos and edge.toPos == toPos:
+                return self.child(i)
+        return None
+
+    def visits(self):
+        return np.array([edge.stats['N'] for edge in self.edges], dtype='float64')
+
+    def addPriorNoise(self, noise, weight):
+        for edge, eps in zip(self.edges, noise):
+            edge.stats['P'] = edge.stats['P'] * (1. - weight) + weight * eps
+
 
 class Edge:
     def __init__(self, inNode, outNode, prior, fromPos, toPos):
+        """
+        `outNode` may be None, in which case the child node is built
+        the first time it is accessed.
+        """
         self.inNode = inNode
-        self.outNode = outNode
+        self._outNode = outNode
         self.currPlayer = inNode.currPlayer
         self.fromPos = fromPos
         self.toPos = toPos
@@ -39,128 +113,446 @@ class Edge:
             'P': prior
         }
 
+    @property
+    def outNode(self):
+        if self._outNode is None:
+            self._outNode = build_child(self.inNode, self.fromPos, self.toPos)
+        return self._outNode
+
+
+class ArrayNode:
+    def __init__(self, state, currPlayer):
+        """
+        Node of the 'arrays' tree store: the N/W/Q/P statistics of all children
+        are contiguous float arrays, so that selection is one vectorised argmax.
+        Children are built on first visit, as with Edge.
+        """
+        self.state = state
+        self.currPlayer = currPlayer
+        self.fromPos = []
+        self.toPos = []
+        self.children = []
+        self.N = self.W = self.Q = self.P = None
+        self.N_sum = 0
+        self.pi = None          # Set on the root by MCTS.search
+
+    def isLeaf(self):
+        return len(self.children) == 0
+
+    def nextPlayer(self):
+        self.currPlayer = (self.currPlayer % 6) + 1  # Cycle through six players
+
+    def expand(self, moves, priors):
+        num_moves = len(moves)
+        self.fromPos = [move[0] for move in moves]
+        self.toPos = [move[1] for move in moves]
+        self.children = [None] * num_moves
+        self.N = np.zeros(num_moves)
+        self.W = np.zeros(num_moves)
+        self.Q = np.zeros(num_moves)
+        self.P = np.array(priors, dtype='float64')
+
+    def select(self, cpuct):
+        QU = self.Q + (cpuct * math.sqrt(self.N_sum)) * self.P / (1. + self.N)
+        chosen = np.flatnonzero(QU > QU.max() - EPSILON)
+        # Choose a random node among ties to continue simulation
+        return int(chosen[0]) if len(chosen) == 1 else int(random.choice(chosen))
+
+    def child(self, index, table=None):
+        node = self.children[index]
+        if node is None:
+            node = self.children[index] = build_child(self, self.fromPos[index], self.toPos[index], table)
+        return node
+
+    def edge(self, index):
+        return ArrayEdge(self, index)
+
+    def update(self, index, value):
+        self.N_sum += 1
+        n = self.N[index] = self.N[index] + 1
+        w = self.W[index] = self.W[index] + value
+        self.Q[index] = w / n
+
+    def virtualLoss(self, index, loss):
+        self.N_sum += loss
+        n = self.N[index] = self.N[index] + loss
+        w = self.W[index] = self.W[index] - loss
+        self.Q[index] = w / n if n else 0.
+
+    def moves(self):
+        return list(zip(self.fromPos, self.toPos))
+
+    def findChild(self, fromPos, toPos):
+        for i, move in enumerate(zip(self.fromPos, self.toPos)):
+            if move == (fromPos, toPos):
+                return self.child(i)
+        return None
+
+    def visits(self):
+        return self.N
+
+    def addPriorNoise(self, noise, weight):
+        self.P *= (1. - weight)
+        self.P += weight * np.asarray(noise)
+
+
+class ArrayEdge:
+    def __init__(self, inNode, index):
+        """
+        Read-only Edge-like view of one child of an ArrayNode
+        """
+        self.inNode = inNode
+        self.index = index
+        self.currPlayer = inNode.currPlayer
+        self.fromPos = inNode.fromPos[index]
+        self.toPos = inNode.toPos[index]
+
+    @property
+    def outNode(self):
+        return self.inNode.child(self.index)
+
+    @property
+    def stats(self):
+        node, i = self.inNode, self.index
+        return {'N': node.N[i], 'W': node.W[i], 'Q': node.Q[i], 'P': node.P[i]}
+
+
+TREE_STORES = {'edges': Node, 'arrays': ArrayNode}
+
+
+def build_child(node, fromPos, toPos, table=None):
+    """
+    Returns the node reached by playing the move from `node`, of the same tree store.
+    With a transposition table, an existing node for the same position is shared.
+    """
+    if table is not None:
+        return table.child(node, fromPos, toPos)
+
+    # Generate the next player's moves on the parent first: the children are cloned with
+    # them in the move cache, and each only regenerates the checkers its move affects
+    next_player = (node.currPlayer % 6) + 1    # Cycle through six players
+    if node.state.move_cache is not None:
+        node.state.get_valid_moves(next_player)
+
+    next_state = node.state.clone()
+    next_state.place(node.currPlayer, fromPos, toPos)
+    return type(node)(next_state, next_player)
+
+
+def leaf_model_inputs(leafNodes):
+    """
+    Returns the model inputs at the leaf nodes. With TRACK_INPUT_PLANES, the planes tracked
+    by the boards are copied (utils.tracked_model_inputs) instead of rebuilt by to_model_inputs.
+    """
+    boards = [leaf.state for leaf in leafNodes]
+    cur_players = [leaf.currPlayer for leaf in leafNodes]
+    if TRACK_INPUT_PLANES and all(state.input_planes is not None for state in boards):
+        return utils.tracked_model_inputs(boards, cur_players)
+    return utils.to_model_inputs(boards, cur_players)
+
+
+
+def evaluate_batch(model, leafNodes, cache=None):
+    """
+    Returns the model's policies and values at the leaf nodes, from one forward pass
+    over the leaves missing from the evaluation cache
+    """
+    if cache is None:
+        input_boards = leaf_model_inputs(leafNodes)
+        return model.predict_batch(input_boards)
+
+    keys = [evaluation_cache.position_key(leaf.state, leaf.currPlayer) for leaf in leafNodes]
+    evaluations = [cache.get(key) for key in keys]
+    missing = [i for i, evaluation in enumerate(evaluations) if evaluation is None]
+    if missing:
+        input_boards = leaf_model_inputs([leafNodes[i] for i in missing])
+        p_batch, v_batch = model.predict_batch(input_boards)
+        for i, p_evaluated, v_evaluated in zip(missing, p_batch, v_batch):
+            evaluations[i] = (p_evaluated, v_evaluated)
+            cache.put(keys[i], p_evaluated, v_evaluated)
+
+    return np.array([p for p, v in evaluations]), np.array([v for p, v in evaluations])
+
+
+class TranspositionTable:
+    def __init__(self, max_size=TRANSPOSITION_TABLE_SIZE):
+        """
+        Bounded map from (position hash, player to move) to the node of that position,
+        so that the same position reached by different move orders shares one node
+        and its statistics. When full, the oldest entries are dropped; their nodes
+        stay in the tree but are no longer shared.
+        """
+        self.max_size = max_size
+        self.nodes = {}
+        self.hits = 0                   # Children found in the table instead of built
+        self.evaluations_saved = 0      # Hits on nodes that had already been evaluated
+
+    def add(self, node, key=None):
+        if key is None:
+            key = (node.state.zobrist_hash, node.currPlayer)
+        if len(self.nodes) >= self.max_size:
+            del self.nodes[next(iter(self.nodes))]
+        self.nodes[key] = node
+
+    def child(self, node, fromPos, toPos):
+        next_player = (node.currPlayer % 6) + 1
+        key = (node.state.zobrist_after(node.currPlayer, fromPos, toPos), next_player)
+        child = self.nodes.get(key)
+        if child is None:
+            child = build_child(node, fromPos, toPos)
+            self.add(child, key)
+        else:
+            self.hits += 1
+            if not child.isLeaf():
+                self.evaluations_saved += 1
+        return child
+
+
+def make_node(state, currPlayer, tree_store=TREE_STORE):
+    """
+    Returns a root node of the given tree store ('edges' or 'arrays')
+    """
+    return TREE_STORES[tree_store](state, currPlayer)
+
 
 class MCTS:
-    def __init__(self, root, model, cpuct=C_PUCT, num_itr=MCTS_SIMULATIONS, tree_tau=TREE_TAU):
+    def __init__(self, root, model, cpuct=C_PUCT, num_itr=MCTS_SIMULATIONS, tree_tau=TREE_TAU, batch_size=MCTS_BATCH_SIZE,
+                 table_size=TRANSPOSITION_TABLE_SIZE):
+        """
+        With `batch_size` > 1, each round of the search collects that many leaves
+        using virtual loss and evaluates them with a single batched forward pass.
+        With `table_size` > 0, transpositions share nodes through a TranspositionTable,
+        which turns the tree into a DAG.
+        """
         self.root = root
         self.cpuct = cpuct
         self.num_itr = num_itr
         self.model = model
         self.tree_tau = tree_tau
+        self.batch_size = batch_size
+
+        self.table = None
+        if table_size > 0:
+            self.table = TranspositionTable(table_size)
+            self.table.add(root)
+
+        self.cache = evaluation_cache.cache_for(model)
 
 
     def moveToLeaf(self):
+        """
+        Returns the leaf reached by PUCT selection and the path to it,
+        as a list of (node, child index) pairs
+        """
         breadcrumbs = []
         currentNode = self.root
+        path_nodes = {id(currentNode)}
 
         while not currentNode.isLeaf():
-            maxQU = float('-inf')
-            chosen_edges = []
-            N_sum = 0
+            index = currentNode.select(self.cpuct)
+            breadcrumbs.append((currentNode, index))
+            currentNode = currentNode.child(index, self.table)
+
+            # Shared nodes can lead back to a position already on the path
+            if id(currentNode) in path_nodes:
+                break
+            path_nodes.add(id(currentNode))
 
-            for edge in currentNode.edges:
-                N_sum += edge.stats['N']
+        return currentNode, breadcrumbs
 
-            for edge in currentNode.edges:
-                U = self.cpuct * edge.stats['P'] * np.sqrt(N_sum) / (1. + edge.stats['N'])
-                QU = edge.stats['Q'] + U
 
-                if QU > maxQU:
-                    maxQU = QU
-                    chosen_edges = [edge]
-                elif math.fabs(QU - maxQU) < EPSILON:
-                    chosen_edges.append(edge)
+    def evaluate(self, leafNode):
+        """
+        Returns the model's policy and value at the leaf node
+        """
+        if self.cache is None:
+            return self.model.predict(leaf_model_inputs([leafNode])[0])
 
-            # Choose a random node to continue simulation
-            sampled_edge = random.choice(chosen_edges)
-            breadcrumbs.append(sampled_edge)
-            currentNode = sampled_edge.outNode
+        key = evaluation_cache.position_key(leafNode.state, leafNode.currPlayer)
+        cached = self.cache.get(key)
+        if cached is not None:
+            return cached
+        p_evaluated, v_evaluated = self.model.predict(leaf_model_inputs([leafNode])[0])
+        self.cache.put(key, p_evaluated, v_evaluated)
+        return p_evaluated, v_evaluated
 
-        return currentNode, breadcrumbs
+
+    def evaluateBatch(self, leafNodes):
+        """
+        Returns the model's policies and values at the leaf nodes, from one forward pass
+        """
+        return evaluate_batch(self.model, leafNodes, self.cache)
 
 
     def expandAndBackUp(self, leafNode, breadcrumbs):
-        assert leafNode.isLeaf()
+        if not leafNode.isLeaf():
+            # The path came back to a position already on it: score the cycle as a draw
+            self.backUp(leafNode, breadcrumbs, REWARD['draw'])
+            return
+
         winner = leafNode.state.check_win()
         if winner:
-            for edge in breadcrumbs:
-                # If a win state occurred, then then leafNode must be the turn of the lost player
-                # Therefore when backing up, the leafNode player gets negative reward
-                direction = -1 if edge.currPlayer == leafNode.currPlayer else 1
-                edge.stats['N'] += 1
-                edge.stats['W'] += REWARD['win'] * direction
-                edge.stats['Q'] = edge.stats['W'] / float(edge.stats['N'])  # Use float() for python2 compatibility
+            # If a win state occurred, then then leafNode must be the turn of the lost player
+            # Therefore when backing up, the leafNode player gets negative reward
+            self.backUp(leafNode, breadcrumbs, -REWARD['win'])
             return
 
         # Use model to make prediction at a leaf node
-        p_evaluated, v_evaluated = self.model.predict(utils.to_model_input(leafNode.state, leafNode.currPlayer))
-
-        valid_actions = leafNode.state.get_valid_moves(leafNode.currPlayer)
-
-        for checker_pos, action_set in valid_actions.items():
-            checker_id = leafNode.state.checkers_id[leafNode.currPlayer][checker_pos]
-            for destination_pos in action_set:
-                # Get index in neural net output vector
-                prior_index = utils.encode_checker_index(checker_id, destination_pos)
-                # next_player = PLAYER_ONE + PLAYER_TWO - leafNode.currPlayer
-                next_player = (leafNode.currPlayer % 6) + 1  # Cycle through six players
-                # Set up new state of game
-                next_state = copy.deepcopy(leafNode.state)
-                next_state.place(leafNode.currPlayer, checker_pos, destination_pos)
-                # Build new edge and node for the new state
-                newNode = Node(next_state, next_player)
-                newEdge = Edge(leafNode, newNode, p_evaluated[prior_index], checker_pos, destination_pos)
-                leafNode.edges.append(newEdge)
-
-        # Back up the value
-        for edge in breadcrumbs:
-            # The value is from the perspective of leafNode player
-            # so the direction is positive for the leafNode player
-            direction = 1 if edge.currPlayer == leafNode.currPlayer else -1
-            edge.stats['N'] += 1
-            edge.stats['W'] += v_evaluated * direction
-            edge.stats['Q'] = edge.stats['W'] / float(edge.stats['N']) # Use float() for python2 compatibility
+        p_evaluated, v_evaluated = self.evaluate(leafNode)
+        self.expand(leafNode, p_evaluated)
+        self.backUp(leafNode, breadcrumbs, v_evaluated)
+
+
+    def expand(self, leafNode, p_evaluated):
+        # Priors over the legal moves only, gathered from the policy in one go
+        moves, indices = utils.legal_moves(leafNode.state, leafNode.currPlayer)
+        priors = utils.legal_policy(p_evaluated, indices)
+
+        # Child states are built when their edges are first visited
+        leafNode.expand(moves, priors)
+
+
+    def backUp(self, leafNode, breadcrumbs, value):
+        """
+        Back up a value given from the perspective of the leafNode player
+        """
+        for node, index in breadcrumbs:
+            # The direction is positive for the edges played by the leafNode player
+            direction = 1 if node.currPlayer == leafNode.currPlayer else -1
+            node.update(index, value * direction)
+
+
+    def addVirtualLoss(self, breadcrumbs, loss=VIRTUAL_LOSS):
+        """
+        Count pending simulations along the path as losses for the players making
+        the moves, so that other simulations of the batch prefer other paths.
+        A negative `loss` takes the virtual loss back.
+        """
+        for node, index in breadcrumbs:
+            node.virtualLoss(index, loss)
+
+
+    def collectLeaves(self, num_sims):
+        """
+        Run up to `num_sims` simulations down to leaves needing an evaluation,
+        holding them with virtual loss. Terminal and cycle leaves are backed up at once.
+        Collection stops early when a pending leaf is reached again, since
+        the following simulations would most likely end there too.
+        Returns the number of simulations run, the pending (leaf, breadcrumbs) pairs
+        and the distinct leaves to evaluate.
+        """
+        pending = []
+        leafNodes = []
+        leaf_ids = set()
+        num_run = 0
+        while num_run < num_sims:
+            leafNode, breadcrumbs = self.moveToLeaf()
+            num_run += 1
+            if not leafNode.isLeaf() or leafNode.state.check_win():
+                self.expandAndBackUp(leafNode, breadcrumbs)     # Cycle or terminal: no evaluation needed
+                continue
+            self.addVirtualLoss(breadcrumbs)
+            pending.append((leafNode, breadcrumbs))
+            # The same leaf is evaluated only once
+            if id(leafNode) in leaf_ids:
+                break
+            leaf_ids.add(id(leafNode))
+            leafNodes.append(leafNode)
+
+        return num_run, pending, leafNodes
+
+
+    def completeLeaves(self, pending, leafNodes, p_evaluated, v_evaluated):
+        """
+        Take back the virtual loss of the pending simulations, then expand and back up
+        their leaves given the evaluations of `leafNodes`
+        """
+        leaf_indices = {id(leafNode): index for index, leafNode in enumerate(leafNodes)}
+        for leafNode, breadcrumbs in pending:
+            self.addVirtualLoss(breadcrumbs, -VIRTUAL_LOSS)
+            index = leaf_indices[id(leafNode)]
+            if leafNode.isLeaf():
+                self.expand(leafNode, p_evaluated[index])
+            self.backUp(leafNode, breadcrumbs, v_evaluated[index])
+
+
+    def simulateBatch(self, num_sims):
+        """
+        Run up to `num_sims` simulations, evaluating all their leaves with one model call.
+        Returns the number of simulations run.
+        """
+        num_run, pending, leafNodes = self.collectLeaves(num_sims)
+        if len(pending) > 0:
+            p_evaluated, v_evaluated = self.evaluateBatch(leafNodes)
+            self.completeLeaves(pending, leafNodes, p_evaluated, v_evaluated)
+        return num_run
+
+
+    def addDirichletNoise(self, alpha=DIRICHLET_ALPHA, weight=DIR_NOISE_FACTOR):
+        """
+        Add Dirichlet noise to prior probs at the (expanded) root so all moves may be tried
+        """
+        moves = self.root.moves()
+        dirichlet_noise = np.random.dirichlet(np.ones(len(moves)) * alpha)
+        self.root.addPriorNoise(dirichlet_noise, weight)
 
 
     def search(self):
         # Build Monte Carlo tree from root using lots of simulations
-        for i in range(self.num_itr):
-            leafNode, breadcrumbs = self.moveToLeaf()
-            self.expandAndBackUp(leafNode, breadcrumbs)
-
+        if self.batch_size > 1:
+            num_sims = 0
+            while num_sims < self.num_itr:
+                num_sims += self.simulateBatch(min(self.batch_size, self.num_itr - num_sims))
+        else:
+            for i in range(self.num_itr):
+                leafNode, breadcrumbs = self.moveToLeaf()
+                self.expandAndBackUp(leafNode, breadcrumbs)
+
+        return self.choose()
+
+
+    def choose(self):
+        """
+        Returns the search policy PI at the root and an edge sampled from it
+        """
         # Calculat PI and sample an edge
-        chosen_edges = []
-        maxN = float('-inf')
-
-        for edge in self.root.edges:
-            probability = pow(edge.stats['N'], (1. / self.tree_tau))
-            checker_id = self.root.state.checkers_id[self.root.currPlayer][edge.fromPos]
-            neural_net_index = utils.encode_checker_index(checker_id, edge.toPos)
-            self.root.pi[neural_net_index] = probability
+        moves = self.root.moves()
+        visits = self.root.visits()
+        # Scale by the max count first so that a small tau does not overflow
+        probabilities = np.power(visits / visits.max(), 1. / self.tree_tau)
+        probabilities /= np.sum(probabilities)
 
-        self.root.pi /= np.sum(self.root.pi)
+        checkers_id = self.root.state.checkers_id[self.root.currPlayer]
+        neural_net_indices = utils.policy_indices([checkers_id[fromPos] for fromPos, _ in moves], [toPos for _, toPos in moves])
+        self.root.pi = np.zeros(utils.POLICY_SIZE, dtype='float64')
+        self.root.pi[neural_net_indices] = probabilities
 
         # Sample an action with given probablities
-        sampled_index = np.random.choice(np.arange(len(self.root.pi)), p=self.root.pi)
-        sampled_checker_id, sampled_to = utils.decode_checker_index(sampled_index)
-        sampled_from = self.root.state.checkers_pos[self.root.currPlayer][sampled_checker_id]
-
-        # Get the edge corresponding to the sampled action
-        sampled_edge = None
-        for edge in self.root.edges:
-            if edge.fromPos == sampled_from and edge.toPos == sampled_to:
-                sampled_edge = edge
-                break
-
-        assert sampled_edge != None
+        sampled_index = np.random.choice(len(moves), p=probabilities)
+        sampled_edge = self.root.edge(sampled_index)
 
         return self.root.pi, sampled_edge
 
 
 if __name__ == '__main__':
-    count = 0
-    board = board.Board()
-    node = Node(board, 1)
-    model = ResidualCNN()
-    tree = MCTS(node, model)
-
+    """
+    Compare the simulation rate of the tree stores, with random priors and values
+    in place of the model so that only the tree overhead is measured
+    """
+    import time
+
+    class RandomMCTS(MCTS):
+        def evaluate(self, leafNode):
+            return np.random.dirichlet(np.ones(utils.POLICY_SIZE)), np.random.uniform(-1, 1)
+
+    for tree_store in TREE_STORES:
+        random.seed(0)
+        np.random.seed(0)
+        tree = RandomMCTS(make_node(board.Board(), PLAYER_ONE, tree_store), model=None, num_itr=MCTS_SIMULATIONS)
+        start = time.time()
+        for i in range(20):
+            tree.search()
+        elapsed = time.time() - start
+        print('{:>6}: {:.0f} simulations per second'.format(tree_store, 20 * tree.num_itr / elapsed))
+        if tree.table is not None:
+            print('{:>6}: {} transposition hits, {} evaluations saved'.format(tree_store, tree.table.hits, tree.table.evaluations_saved))
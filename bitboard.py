@@ -0,0 +1,322 @@
+import numpy as np
+
+from config import *
+
+
+"""
+Bitboard move generation for Board.
+
+The playable cells of a board (the cells not marked OFF_BOARD) are numbered
+in row-major order, and a set of cells is a Python int with one bit per cell.
+Rays, step neighbours and long-jump landings are precomputed once for each
+board geometry, so generating the moves of a checker only needs a handful of
+integer operations per visited cell.
+"""
+
+
+OFF_BOARD = 9                                 # Sentinel value of non-playable cells in Board.board
+
+# Same order as Board.directions
+DIRECTIONS = [(-1, 0), (0, 1), (1, 1), (1, 0), (0, -1), (-1, -1)]
+
+_geometries = {}
+
+
+def geometry_for(cur_board):
+    """
+    Returns the cached Geometry for the playable cells of the given 2D board plane
+    """
+    return geometry_from_mask((cur_board != OFF_BOARD).tobytes())
+
+
+def geometry_from_mask(mask_bytes):
+    """
+    Returns the cached Geometry given the raw bytes of a playable-cell mask
+    """
+    geometry = _geometries.get(mask_bytes)
+    if geometry is None:
+        playable = np.frombuffer(mask_bytes, dtype='bool').reshape((BOARD_HEIGHT, BOARD_WIDTH))
+        geometry = Geometry(playable)
+        _geometries[mask_bytes] = geometry
+    return geometry
+
+
+def geometry_from_packed(packed_mask):
+    """
+    Returns the cached Geometry given the playable-cell mask packed to bits, as pickled
+    """
+    playable = np.unpackbits(np.frombuffer(packed_mask, dtype='uint8'), count=BOARD_HEIGHT * BOARD_WIDTH)
+    return geometry_from_mask(playable.astype('bool').tobytes())
+
+
+class Geometry:
+    def __init__(self, playable):
+        """
+        Precompute the lookup tables for the given boolean mask of playable cells.
+        Each ray stops at the first non-playable cell; a jump over a gap of
+        non-playable cells is kept separately, as the gap acts as the pivot.
+        """
+        self.mask_bytes = playable.tobytes()
+        self.flat_cells = np.flatnonzero(playable.ravel())
+        self.cells = [divmod(int(flat), BOARD_WIDTH) for flat in self.flat_cells]
+        self.cell_index = {cell: i for i, cell in enumerate(self.cells)}
+        self.num_cells = len(self.cells)
+
+        def in_bounds(row, col):
+            return 0 <= row < BOARD_HEIGHT and 0 <= col < BOARD_WIDTH
+
+        self.neighbours = []
+        self.rays = []
+        for row, col in self.cells:
+            neighbours = 0
+            rays = []
+            for row_inc, col_inc in DIRECTIONS:
+                # Walk the in-bound cells of the ray, stopping at the first non-playable cell
+                ray_cells = []
+                r, c = row + row_inc, col + col_inc
+                while in_bounds(r, c) and playable[r, c]:
+                    ray_cells.append(self.cell_index[(r, c)])
+                    r, c = r + row_inc, c + col_inc
+
+                if ray_cells:
+                    neighbours |= 1 << ray_cells[0]
+
+                # Jumps with a checker as the pivot, keyed by the pivot cell
+                jumps = {}
+                for k in range(1, len(ray_cells) // 2 + 1):
+                    clear = 0
+                    for cell in ray_cells[k:2 * k]:
+                        clear |= 1 << cell
+                    jumps[ray_cells[k - 1]] = (1 << ray_cells[2 * k - 1], clear)
+
+                # Jump with the first non-playable cell as the pivot
+                gap_jump = None
+                k = len(ray_cells) + 1
+                if in_bounds(r, c):
+                    path = [(r + i * row_inc, c + i * col_inc) for i in range(1, k + 1)]
+                    if all(in_bounds(*cell) and playable[cell] for cell in path):
+                        clear = 0
+                        for cell in path:
+                            clear |= 1 << self.cell_index[cell]
+                        gap_jump = (1 << self.cell_index[path[-1]], clear)
+
+                ray = 0
+                for cell in ray_cells:
+                    ray |= 1 << cell
+                ascending = (row_inc, col_inc) > (0, 0)     # Row-major numbering grows along the ray
+                rays.append((ascending, ray, jumps, gap_jump))
+
+            self.neighbours.append(neighbours)
+            self.rays.append(rays)
+
+        # Influence of each cell: the cells whose occupancy can change the jumps from it,
+        # which are its rays and the cells its jumps must clear
+        self.influence = []
+        for rays in self.rays:
+            influence = 0
+            for _, ray, jumps, gap_jump in rays:
+                influence |= ray
+                for _, clear in jumps.values():
+                    influence |= clear
+                if gap_jump is not None:
+                    influence |= gap_jump[1]
+            self.influence.append(influence)
+
+    def __deepcopy__(self, memo):
+        # Geometries are immutable and shared by all boards of the same shape
+        return self
+
+    def __reduce__(self):
+        return geometry_from_packed, (np.packbits(np.frombuffer(self.mask_bytes, dtype='bool')).tobytes(),)
+
+    def occupancy(self, cur_board):
+        """
+        Returns the bitboard of occupied playable cells in the given 2D board plane
+        """
+        occupied = cur_board.ravel()[self.flat_cells] != 0
+        return int.from_bytes(np.packbits(occupied, bitorder='little').tobytes(), 'little')
+
+    def cells_of(self, bits):
+        """
+        Returns the list of (row, col) cells in the given bitboard, in row-major order
+        """
+        cells = []
+        while bits:
+            low = bits & -bits
+            cells.append(self.cells[low.bit_length() - 1])
+            bits ^= low
+        return cells
+
+    def jump_targets(self, cell, occupied):
+        """
+        Returns the bitboard of cells reachable from `cell` with a single jump
+        """
+        targets = 0
+        for ascending, ray, jumps, gap_jump in self.rays[cell]:
+            blockers = occupied & ray
+            if blockers:
+                # The nearest checker along the ray is the pivot
+                if ascending:
+                    jump = jumps.get((blockers & -blockers).bit_length() - 1)
+                else:
+                    jump = jumps.get(blockers.bit_length() - 1)
+            else:
+                jump = gap_jump
+
+            if jump is not None and not occupied & jump[1]:
+                targets |= jump[0]
+        return targets
+
+    def checker_moves(self, occupied, cell):
+        """
+        Returns the bitboard of destinations for the checker at `cell`.
+        Jump chains are found by flood filling from the checker, one frontier
+        of landing cells at a time. As in Board.valid_checker_jump_moves,
+        empty neighbours count as visited before any jump, so chains do not
+        continue through them.
+        """
+        origin = 1 << cell
+        occupied &= ~origin                     # The moving checker does not block its own jumps
+        visited = (self.neighbours[cell] & ~occupied) | origin
+        frontier = origin
+        while frontier:
+            landed = 0
+            while frontier:
+                low = frontier & -frontier
+                landed |= self.jump_targets(low.bit_length() - 1, occupied)
+                frontier ^= low
+            frontier = landed & ~visited
+            visited |= frontier
+        return visited ^ origin
+
+    def reaches(self, occupied, cell, target):
+        """
+        Returns whether the checker at `cell` can move to `target`, the same as testing
+        the target bit of checker_moves, but stopping as soon as a jump lands on it
+        """
+        origin, goal = 1 << cell, 1 << target
+        if goal == origin:
+            return False
+        occupied &= ~origin
+        visited = (self.neighbours[cell] & ~occupied) | origin
+        if visited & goal:
+            return True
+        frontier = origin
+        while frontier:
+            landed = 0
+            while frontier:
+                low = frontier & -frontier
+                landed |= self.jump_targets(low.bit_length() - 1, occupied)
+                if landed & goal:
+                    return True
+                frontier ^= low
+            frontier = landed & ~visited
+            visited |= frontier
+        return False
+
+    def checker_moves_and_reads(self, occupied, cell):
+        """
+        Same as checker_moves, also returning the bitboard of cells whose occupancy the
+        destinations depend on: the neighbours and the influence of every landing cell.
+        The destinations stay the same for as long as none of those cells changes.
+        """
+        origin = 1 << cell
+        occupied &= ~origin
+        reads = self.neighbours[cell]
+        visited = (reads & ~occupied) | origin
+        frontier = origin
+        while frontier:
+            landed = 0
+            while frontier:
+                low = frontier & -frontier
+                landing = low.bit_length() - 1
+                landed |= self.jump_targets(landing, occupied)
+                reads |= self.influence[landing]
+                frontier ^= low
+            frontier = landed & ~visited
+            visited |= frontier
+        return visited ^ origin, reads
+
+    def valid_moves(self, cur_board, positions):
+        """
+        Returns {checker position: [destinations]} for the given checker positions
+        """
+        occupied = self.occupancy(cur_board)
+        return {pos: self.cells_of(self.checker_moves(occupied, self.cell_index[pos])) for pos in positions}
+
+    def move_arrays(self, cur_board, checkers):
+        """
+        Returns the moves of the given {checker id: position} as int16 arrays (from cells, to cells,
+        checker ids), in the order of valid_moves. Cells are numbered row * BOARD_WIDTH + col.
+        """
+        occupied = self.occupancy(cur_board)
+        origins, counts, destinations = [], [], []
+        for pos in checkers.values():
+            cell = self.cell_index[pos]
+            bits = self.checker_moves(occupied, cell)
+            num_moves = len(destinations)
+            while bits:
+                low = bits & -bits
+                destinations.append(low.bit_length() - 1)
+                bits ^= low
+            origins.append(cell)
+            counts.append(len(destinations) - num_moves)
+        from_cells = np.repeat(self.flat_cells[origins], counts).astype('int16')
+        to_cells = self.flat_cells[destinations].astype('int16')
+        checker_ids = np.repeat(np.fromiter(checkers, dtype='int16', count=len(checkers)), counts)
+        return from_cells, to_cells, checker_ids
+
+
+
+if __name__ == '__main__':
+    """
+    Put bitboard.py testcases here: compare against Board.valid_checker_moves
+    """
+    import random
+    import time
+    from board import Board
+
+    def legacy_moves(board, player):
+        return {pos: board.valid_checker_moves(player, pos) for pos in board.checkers_pos[player].values()}
+
+    def assert_same_moves(board, player):
+        expected = legacy_moves(board, player)
+        actual = board.get_valid_moves(player)
+        assert expected.keys() == actual.keys()
+        for pos in expected:
+            assert len(set(actual[pos])) == len(actual[pos])
+            assert set(expected[pos]) == set(actual[pos]), (pos, expected[pos], actual[pos])
+
+    random.seed(0)
+    np.random.seed(0)
+    positions = 0
+    for game in range(30):
+        randomised = game % 3 == 0
+        players = [PLAYER_ONE, PLAYER_TWO] if randomised else list(range(PLAYER_ONE, PLAYER_SIX + 1))
+        board = Board(randomised=randomised)
+        for move in range(100):
+            player = players[move % len(players)]
+            for p in players:
+                assert_same_moves(board, p)
+            positions += 1
+            moves = [(start, end) for start, ends in board.get_valid_moves(player).items() for end in ends]
+            if not moves:
+                break
+            board.place(player, *random.choice(moves))
+    print('Move sets match on {} positions'.format(positions))
+
+    board = Board()
+    for move in range(60):
+        player = PLAYER_ONE + move % 6
+        moves = [(start, end) for start, ends in board.get_valid_moves(player).items() for end in ends]
+        board.place(player, *random.choice(moves))
+
+    start = time.time()
+    for i in range(1000):
+        legacy_moves(board, PLAYER_ONE)
+    legacy_time = time.time() - start
+    start = time.time()
+    for i in range(1000):
+        board.get_valid_moves(PLAYER_ONE)
+    bitboard_time = time.time() - start
+    print('Legacy: {:.1f} us, bitboard: {:.1f} us per call'.format(legacy_time * 1e3, bitboard_time * 1e3))
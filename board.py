@@ -2,12 +2,141 @@ from __future__ import print_function
 import numpy as np
 from config import *
 import board_utils
+import bitboard
 import operator
+import struct
+from array import array
 from collections import deque
+from collections.abc import Mapping
+
+
+# Zobrist keys: one 64-bit key per (player, checker id, cell), plus one per player to move
+_zobrist_rng = np.random.RandomState(20180601)
+ZOBRIST_KEYS = np.frombuffer(_zobrist_rng.bytes(8 * 7 * NUM_CHECKERS * BOARD_HEIGHT * BOARD_WIDTH), dtype='uint64') \
+                 .reshape((7, NUM_CHECKERS, BOARD_HEIGHT * BOARD_WIDTH))
+ZOBRIST_CHECKERS = ZOBRIST_KEYS.tolist()
+ZOBRIST_TO_MOVE = np.frombuffer(_zobrist_rng.bytes(8 * 7), dtype='uint64').tolist()
+
+# The goal regions of check_win and player_progress: the corner diagonals at offset
+# BOARD_WIDTH - ROWS_OF_CHECKERS or more, above (upper right) and below (lower left) the main diagonal
+GOAL_OFFSET = BOARD_WIDTH - ROWS_OF_CHECKERS
+_rows, _cols = np.indices((BOARD_HEIGHT, BOARD_WIDTH))
+UPPER_GOAL = _cols - _rows >= GOAL_OFFSET
+LOWER_GOAL = _rows - _cols >= GOAL_OFFSET
+GOAL_CELLS = int(UPPER_GOAL.sum())              # Cells in each region
+
+# The (row, col) of each cell, numbered row * BOARD_WIDTH + col
+CELLS = [divmod(cell, BOARD_WIDTH) for cell in range(BOARD_HEIGHT * BOARD_WIDTH)]
+
+# Layout of Board.to_bytes: the geometry (0 for the star, 1 for the full board of randomised games),
+# the player to move and the number of history moves, then the cell of each checker of players one
+# to six by checker id, then the (from, to) cells of the history moves, oldest first. Cells are uint16,
+# with NO_CELL for missing checkers and unused history slots.
+BOARD_BYTES_FORMAT = '<3B{}H'.format(6 * NUM_CHECKERS + 2 * TOTAL_HIST_MOVES)
+BOARD_BYTES = struct.calcsize(BOARD_BYTES_FORMAT)
+NO_CELL = 0xFFFF
+
+
+def cell_number(pos):
+    """
+    Returns row * BOARD_WIDTH + col for the given (row, col), or None if it is out of bounds
+    """
+    row, col = pos
+    if 0 <= row < BOARD_HEIGHT and 0 <= col < BOARD_WIDTH:
+        return row * BOARD_WIDTH + col
+    return None
+
+
+class CheckerPositions(Mapping):
+    """
+    Read-only {checker id: (row, col)} view of a player's checkers, backed by Board.checker_cells
+    """
+    __slots__ = ('checker_cells', 'cell_checkers', 'player')
+
+    def __init__(self, checker_cells, cell_checkers, player):
+        # Only the lookup tables are referred to, so that a board and its cached views do not form a cycle
+        self.checker_cells = checker_cells
+        self.cell_checkers = cell_checkers
+        self.player = player
+
+    def cells(self):
+        """
+        Returns the cells of the player's checkers by checker id, -1 for the missing ones
+        """
+        base = self.player * NUM_CHECKERS
+        return self.checker_cells[base:base + NUM_CHECKERS]
+
+    def __getitem__(self, checker_id):
+        if checker_id in range(NUM_CHECKERS):
+            cell = self.checker_cells[self.player * NUM_CHECKERS + checker_id]
+            if cell >= 0:
+                return CELLS[cell]
+        raise KeyError(checker_id)
+
+    def __iter__(self):
+        return iter([checker_id for checker_id, cell in enumerate(self.cells()) if cell >= 0])
+
+    def __len__(self):
+        return NUM_CHECKERS - self.cells().count(-1)
+
+    def items(self):
+        return [(checker_id, CELLS[cell]) for checker_id, cell in enumerate(self.cells()) if cell >= 0]
+
+    def values(self):
+        return [CELLS[cell] for cell in self.cells() if cell >= 0]
+
+    def copy(self):
+        return dict(self.items())
+
+    def __repr__(self):
+        return repr(self.copy())
+
+
+class CheckerIds(CheckerPositions):
+    """
+    Read-only {(row, col): checker id} view of a player's checkers, backed by Board.cell_checkers
+    """
+    __slots__ = ()
+
+    def __getitem__(self, checker_pos):
+        cell = cell_number(checker_pos)
+        if cell is not None:
+            checker = self.cell_checkers[cell]
+            if checker >= 0 and checker // NUM_CHECKERS == self.player:
+                return checker % NUM_CHECKERS
+        raise KeyError(checker_pos)
+
+    def __iter__(self):
+        return iter(CheckerPositions.values(self))
+
+    def items(self):
+        return [(CELLS[cell], checker_id) for checker_id, cell in enumerate(self.cells()) if cell >= 0]
+
+    def values(self):
+        return [checker_id for checker_id, cell in enumerate(self.cells()) if cell >= 0]
 
 
 class Board:
-    def __init__(self, randomised=False):
+    # Attributes of every board; the directions and geometry are shared between boards
+    __slots__ = ('planes', 'board_head', 'board', 'checker_cells', 'cell_checkers', 'views', 'hist_moves',
+                 'geometry', 'move_cache', 'moves_changed', 'player_to_move', 'zobrist_hash',
+                 'upper_counts', 'lower_counts', 'row_sums', 'input_planes', 'planes_head')
+
+    # == Directions Map ==
+    #
+    #   NW north
+    #  west     east
+    #      south SE
+    directions = [
+        (-1, 0),    # north
+        (0, 1),     # east
+        (1, 1),     # southeast
+        (1, 0),     # south
+        (0, -1),    # west
+        (-1, -1)    # northwest
+    ]
+
+    def __init__(self, randomised=False, track_planes=TRACK_INPUT_PLANES, cache_moves=MOVE_CACHE):
         """
         Get the numpy array representing this board.
         Array is shaped 7x7x3, where the first 7x7 plane
@@ -15,8 +144,30 @@ class Board:
         two previous steps.
         PLAYER_ONE and PLAYER_TWO's checkers are initialised
         at bottom left and top right corners respectively.
+        With track_planes, the checker id planes of the model input
+        are kept up to date by place() and undo().
+        With cache_moves, get_valid_moves reuses the moves that
+        the moves made since did not affect.
+        Copies the initial position from a template built once.
         """
-        self.board = np.zeros((BOARD_WIDTH, BOARD_HEIGHT, BOARD_HIST_MOVES), dtype='uint8')  # Initialize empty board
+        self.copy_from(INITIAL_BOARD)
+        self.move_cache = [] if cache_moves else None
+        self.reset_move_cache()
+        if track_planes:
+            self.reset_input_planes()
+
+        if randomised:
+            self.randomise_initial_state()
+
+    def set_initial_state(self):
+        """
+        Set up the initial position from scratch. PLAYER_ONE to PLAYER_SIX start in the six corners.
+        """
+        # History planes in a ring buffer, each plane stored twice so that the last BOARD_HIST_MOVES
+        # are a contiguous slice: self.board[:, :, k] is a view of the board k moves ago
+        self.planes = np.zeros((BOARD_HIST_MOVES * 2, BOARD_WIDTH, BOARD_HEIGHT), dtype='uint8')
+        self.board_head = 0
+        self.view_board()
         # self.board[:, :, 0] = np.array([[0, 0, 0, 0, 2, 2, 2],
         #                                 [0, 0, 0, 0, 0, 2, 2],
         #                                 [0, 0, 0, 0, 0, 0, 2],
@@ -46,20 +197,6 @@ class Board:
                                         [9, 9, 9, 9, 4,   4, 9, 9, 9, 9,   9, 9, 9, 9, 9,   9, 9],
                                         [9, 9, 9, 9, 4,   9, 9, 9, 9, 9,   9, 9, 9, 9, 9,   9, 9]])
 
-        # == Directions Map ==
-        #
-        #   NW north
-        #  west     east
-        #      south SE
-        self.directions = [
-            (-1, 0),    # north
-            (0, 1),     # east
-            (1, 1),     # southeast
-            (1, 0),     # south
-            (0, -1),    # west
-            (-1, -1)    # northwest
-        ]
-
         # self.checkers_pos = [None,
         #                      {0: (BOARD_HEIGHT-1, 0), 1: (BOARD_HEIGHT-2, 0), 2: (BOARD_HEIGHT-1, 1),
         #                       3: (BOARD_HEIGHT-3, 0), 4: (BOARD_HEIGHT-2, 1), 5: (BOARD_HEIGHT-1, 2)},
@@ -72,7 +209,7 @@ class Board:
         #                     {(0, BOARD_WIDTH-1): 0, (1, BOARD_WIDTH-1): 1, (0, BOARD_WIDTH-2): 2,
         #                      (2, BOARD_WIDTH-1): 3, (1, BOARD_WIDTH-2): 4, (0, BOARD_WIDTH-3): 5}]
         
-        self.checkers_pos = [None,
+        initial_checkers_pos = [None,
                      {0: (0, 12), 1: (1, 11), 2: (1, 12), 3: (2, 10), 4: (2, 11), 5: (2, 12),
                       6: (3, 9), 7: (3, 10), 8: (3, 11), 9: (3, 12)},
                      {0: (4, 4), 1: (5, 4), 2: (4, 5), 3: (6, 4), 4: (5, 5), 5: (4, 6),
@@ -87,27 +224,62 @@ class Board:
                       6: (4, 13), 7: (5, 13), 8: (6, 13), 9: (7, 13)}
                     ]
 
-        self.checkers_id = [None,
-                    {(0, 12): 0, (1, 11): 1, (1, 12): 2, (2, 10): 3, (2, 11): 4, (2, 12): 5,
-                     (3, 9): 6, (3, 10): 7, (3, 11): 8, (3, 12): 9},
-                    {(4, 4): 0, (5, 4): 1, (4, 5): 2, (6, 4): 3, (5, 5): 4, (4, 6): 5,
-                     (7, 4): 6, (6, 5): 7, (5, 6): 8, (4, 7): 9},
-                    {(12, 0): 0, (12, 1): 1, (11, 1): 2, (12, 2): 3, (11, 2): 4, (10, 2): 5,
-                     (12, 3): 6, (11, 3): 7, (10, 3): 8, (9, 3): 9},
-                    {(16, 4): 0, (15, 5): 1, (15, 4): 2, (14, 6): 3, (14, 5): 4, (14, 4): 5,
-                     (13, 7): 6, (13, 6): 7, (13, 5): 8, (13, 4): 9},
-                    {(12, 12): 0, (11, 12): 1, (12, 11): 2, (10, 12): 3, (11, 11): 4, (12, 10): 5,
-                     (9, 12): 6, (10, 11): 7, (11, 10): 8, (12, 9): 9},
-                    {(4, 16): 0, (4, 15): 1, (5, 15): 2, (4, 14): 3, (5, 14): 4, (6, 14): 5,
-                     (4, 13): 6, (5, 13): 7, (6, 13): 8, (7, 13): 9}
-                   ]
+        self.checker_cells = array('h', [-1]) * (7 * NUM_CHECKERS)
+        self.cell_checkers = array('b', [-1]) * (BOARD_WIDTH * BOARD_HEIGHT)
+        self.views = None
+        for player_num, checkers_pos in enumerate(initial_checkers_pos):
+            if checkers_pos is None:
+                continue
+            for checker_id, checker_pos in checkers_pos.items():
+                self.put_checker(player_num, checker_id, checker_pos)
 
+        self.hist_moves = deque()
+        self.geometry = bitboard.geometry_for(self.board[:, :, 0])
+        self.move_cache = None
+        self.reset_move_cache()
 
+        # The player after the last mover, in six-player order
+        self.player_to_move = PLAYER_ONE
+        self.zobrist_hash = self.compute_zobrist_hash()
+        self.upper_counts, self.lower_counts, self.row_sums = self.compute_progress()
 
-        self.hist_moves = deque()
+        self.input_planes = None
+        self.planes_head = 0
 
-        if randomised:
-            self.randomise_initial_state()
+    @property
+    def checkers_pos(self):
+        """
+        [None, {checker id: (row, col)} for each player], as read-only views of checker_cells
+        """
+        return self.checker_views()[0]
+
+    @property
+    def checkers_id(self):
+        """
+        [None, {(row, col): checker id} for each player], as read-only views of cell_checkers
+        """
+        return self.checker_views()[1]
+
+    def checker_views(self):
+        """
+        Returns (checkers_pos, checkers_id), made once per lookup tables as they only refer to them.
+        Whatever replaces checker_cells or cell_checkers must reset self.views.
+        """
+        if self.views is None:
+            tables = (self.checker_cells, self.cell_checkers)
+            self.views = ([None] + [CheckerPositions(*tables, player_num) for player_num in range(PLAYER_ONE, PLAYER_SIX + 1)],
+                          [None] + [CheckerIds(*tables, player_num) for player_num in range(PLAYER_ONE, PLAYER_SIX + 1)])
+        return self.views
+
+    def put_checker(self, player_num, checker_id, checker_pos):
+        """
+        Record the player's checker at checker_pos in the lookup tables: checker_cells holds
+        the cell of each (player, checker id) and cell_checkers the player * NUM_CHECKERS + checker id
+        on each cell, with -1 for none
+        """
+        cell = checker_pos[0] * BOARD_WIDTH + checker_pos[1]
+        self.checker_cells[player_num * NUM_CHECKERS + checker_id] = cell
+        self.cell_checkers[cell] = player_num * NUM_CHECKERS + checker_id
 
     def randomise_initial_state(self):
         '''
@@ -120,20 +292,101 @@ class Board:
         chosen_indexes = np.random.choice(len(position_list), size=NUM_CHECKERS*2, replace=False)
         chosen_position = [position_list[i] for i in chosen_indexes]
 
-        self.checkers_pos = [None, {}, {}]
-        self.checkers_id = [None, {}, {}]
+        self.checker_cells = array('h', [-1]) * (7 * NUM_CHECKERS)
+        self.cell_checkers = array('b', [-1]) * (BOARD_WIDTH * BOARD_HEIGHT)
+        self.views = None
 
-        # Take care to initialise the checkers_pos/checkers_id lookup table
+        # Take care to initialise the checker lookup tables
         index = 0
         for player_num in [PLAYER_ONE, PLAYER_TWO]:
             for checker_id in range(NUM_CHECKERS):
                 checker_pos = chosen_position[index]
                 self.board[checker_pos][0] = player_num
-                self.checkers_pos[player_num][checker_id] = checker_pos
-                self.checkers_id[player_num][checker_pos] = checker_id
+                self.put_checker(player_num, checker_id, checker_pos)
                 index += 1
 
         assert index == NUM_CHECKERS * 2
+        self.geometry = bitboard.geometry_for(self.board[:, :, 0])
+        self.reset_move_cache()
+        self.zobrist_hash = self.compute_zobrist_hash()
+        self.upper_counts, self.lower_counts, self.row_sums = self.compute_progress()
+        if self.input_planes is not None:
+            self.reset_input_planes()
+
+    def reset_input_planes(self):
+        """
+        Start tracking the checker id planes from the current position, without history.
+        input_planes[slot, player] holds checker id + 1 on the cells of the player's checkers,
+        as a ring buffer over the last BOARD_HIST_MOVES positions: the position k moves ago
+        is in slot (planes_head + k) % BOARD_HIST_MOVES. Plane 0 stays empty.
+        """
+        self.input_planes = np.zeros((BOARD_HIST_MOVES, 7, BOARD_WIDTH, BOARD_HEIGHT), dtype='uint8')
+        self.planes_head = 0
+        for player_num, checkers_pos in enumerate(self.checkers_pos):
+            if checkers_pos is None:
+                continue
+            for checker_id, checker_pos in checkers_pos.items():
+                self.input_planes[0, player_num][checker_pos] = checker_id + 1
+
+    def history_planes(self, players):
+        """
+        Returns the checker id planes of the given players over the last BOARD_HIST_MOVES positions,
+        shaped (BOARD_HIST_MOVES, len(players), BOARD_WIDTH, BOARD_HEIGHT), most recent first
+        """
+        slots = (self.planes_head + np.arange(BOARD_HIST_MOVES)) % BOARD_HIST_MOVES
+        return self.input_planes[slots[:, None], players]
+
+    def view_board(self):
+        """
+        Point self.board at the last BOARD_HIST_MOVES planes of the ring buffer, most recent first
+        """
+        self.board = self.planes[self.board_head:self.board_head + BOARD_HIST_MOVES].transpose(1, 2, 0)
+
+    def compute_zobrist_hash(self):
+        """
+        Returns the 64-bit Zobrist hash of the checkers and the player to move, from scratch.
+        place() keeps `zobrist_hash` up to date incrementally.
+        """
+        cells = np.frombuffer(self.checker_cells, dtype='int16').reshape((7, NUM_CHECKERS))
+        players, checker_ids = np.nonzero(cells >= 0)
+        keys = ZOBRIST_KEYS[players, checker_ids, cells[players, checker_ids]]
+        return ZOBRIST_TO_MOVE[self.player_to_move] ^ int(np.bitwise_xor.reduce(keys))
+
+    def compute_progress(self):
+        """
+        Returns, from scratch, each player's number of checkers in the upper and lower goal
+        regions and the sum of its checkers' human rows, as lists indexed by player number.
+        place() and undo() keep `upper_counts`, `lower_counts` and `row_sums` up to date incrementally.
+        """
+        cur_board = self.board[:, :, 0]
+        upper_counts = [0] + np.bincount(cur_board[UPPER_GOAL], minlength=7)[1:7].tolist()
+        lower_counts = [0] + np.bincount(cur_board[LOWER_GOAL], minlength=7)[1:7].tolist()
+        # Human rows as in board_utils.np_index_to_human_coord
+        cells = np.frombuffer(self.checker_cells, dtype='int16').reshape((7, NUM_CHECKERS))
+        human_rows = cells // BOARD_WIDTH - cells % BOARD_WIDTH + BOARD_WIDTH
+        row_sums = np.where(cells >= 0, human_rows, 0).sum(axis=1).tolist()
+        return upper_counts, lower_counts, row_sums
+
+    def move_progress(self, cur_player, origin_pos, dest_pos):
+        """
+        Update the goal region counts and the row sum of the player for its checker moving
+        """
+        if origin_pos[1] - origin_pos[0] >= GOAL_OFFSET:
+            self.upper_counts[cur_player] -= 1
+        elif origin_pos[0] - origin_pos[1] >= GOAL_OFFSET:
+            self.lower_counts[cur_player] -= 1
+        if dest_pos[1] - dest_pos[0] >= GOAL_OFFSET:
+            self.upper_counts[cur_player] += 1
+        elif dest_pos[0] - dest_pos[1] >= GOAL_OFFSET:
+            self.lower_counts[cur_player] += 1
+        self.row_sums[cur_player] += (dest_pos[0] - dest_pos[1]) - (origin_pos[0] - origin_pos[1])
+
+    def check_progress(self):
+        """
+        Assert that the incremental counters match a full recount
+        """
+        assert (self.upper_counts, self.lower_counts, self.row_sums) == self.compute_progress(), \
+            'Board counters out of sync with the board'
 
     def check_win(self):
         """
@@ -142,22 +395,11 @@ class Board:
             player 1: all checkers to upper right
             player 2: all checkers to lower left
         """
-        cur_board = self.board[:, :, 0]
-        one_win = two_win = True
-        for k in range(BOARD_WIDTH - ROWS_OF_CHECKERS, BOARD_WIDTH):
-            if one_win:
-                up_diag = cur_board.diagonal(k)
-                if not np.array_equal(up_diag, [PLAYER_ONE]*len(up_diag)):
-                    one_win = False
-            if two_win:
-                down_diag = cur_board.diagonal(-k)
-                if not np.array_equal(down_diag, [PLAYER_TWO]*len(down_diag)):
-                    two_win = False
-
-            if not one_win and not two_win:
-                return 0
-
-        return PLAYER_ONE if one_win else PLAYER_TWO
+        if self.upper_counts[PLAYER_ONE] == GOAL_CELLS:
+            return PLAYER_ONE
+        if self.lower_counts[PLAYER_TWO] == GOAL_CELLS:
+            return PLAYER_TWO
+        return 0
 
     def visualise(self, cur_player=None, gap_btw_checkers=3):
         """
@@ -257,56 +499,334 @@ class Board:
 
     def get_valid_moves(self, cur_player):
         """
-        Returns the collection of valid moves given the current player, in np indices
+        Returns the collection of valid moves given the current player, in np indices.
+        Uses the bitboard engine; gives the same move sets as valid_checker_moves.
+        With the move cache, only the checkers without cached moves are generated.
         """
-        valid_moves_set = {}
+        if self.move_cache is None:
+            return self.geometry.valid_moves(self.board[:, :, 0], self.checkers_pos[cur_player].values())
+
+        # Drop the cached moves that depend on cells changed since they were generated
+        cached = self.move_cache[cur_player]
+        changed = self.moves_changed[cur_player]
+        if changed:
+            for checker_pos in [checker_pos for checker_pos, (_, reads) in cached.items() if reads & changed]:
+                del cached[checker_pos]
+            self.moves_changed[cur_player] = 0
+
+        occupied = None
+        valid_moves = {}
         for checker_pos in self.checkers_pos[cur_player].values():
-            valid_moves_set[checker_pos] = self.valid_checker_moves(cur_player, checker_pos)
-        return valid_moves_set
+            entry = cached.get(checker_pos)
+            if entry is None:
+                if occupied is None:
+                    occupied = self.geometry.occupancy(self.board[:, :, 0])
+                destinations, reads = self.geometry.checker_moves_and_reads(occupied, self.geometry.cell_index[checker_pos])
+                entry = cached[checker_pos] = (self.geometry.cells_of(destinations), reads)
+            valid_moves[checker_pos] = entry[0]
+
+        if DEBUG_BOARD:
+            assert valid_moves == self.geometry.valid_moves(self.board[:, :, 0], self.checkers_pos[cur_player].values()), \
+                'Move cache out of sync with the board'
+        return valid_moves
+
+    def get_move_arrays(self, cur_player):
+        """
+        Same moves as get_valid_moves, flattened to int16 arrays (from cells, to cells, checker ids)
+        in the same order. Cells are numbered row * BOARD_WIDTH + col.
+        """
+        if self.move_cache is None:
+            return self.geometry.move_arrays(self.board[:, :, 0], self.checkers_pos[cur_player])
+
+        valid_moves = self.get_valid_moves(cur_player)
+        checkers_id = self.checkers_id[cur_player]
+        counts = [len(dests) for dests in valid_moves.values()]
+        origins = [row * BOARD_WIDTH + col for row, col in valid_moves]
+        to_cells = [row * BOARD_WIDTH + col for dests in valid_moves.values() for row, col in dests]
+        from_cells = np.repeat(np.array(origins, dtype='int16'), counts)
+        checker_ids = np.repeat(np.array([checkers_id[pos] for pos in valid_moves], dtype='int16'), counts)
+        return from_cells, np.array(to_cells, dtype='int16'), checker_ids
+
+    def is_legal_move(self, cur_player, origin_pos, dest_pos):
+        """
+        Returns whether moving the player's checker at origin_pos to dest_pos is valid,
+        without generating the other moves. Positions from outside, e.g. lists or cells
+        off the board, are accepted and simply give False.
+        """
+        origin_pos, dest_pos = tuple(origin_pos), tuple(dest_pos)
+        cell = self.geometry.cell_index.get(origin_pos)
+        target = self.geometry.cell_index.get(dest_pos)
+        if cell is None or target is None or origin_pos not in self.checkers_id[cur_player]:
+            return False
+        if self.board[dest_pos[0], dest_pos[1], 0] != 0:
+            return False
+        return self.geometry.reaches(self.geometry.occupancy(self.board[:, :, 0]), cell, target)
+
+    def reset_move_cache(self):
+        """
+        Empty the move cache, e.g. after writing to self.board directly.
+        move_cache[player] maps each checker position to its destinations and the bitboard
+        of cells they depend on. moves_changed[player] collects the cells changed by moves
+        since, and get_valid_moves drops the entries that depend on them.
+        """
+        if self.move_cache is not None:
+            self.move_cache = [{} for _ in range(7)]
+        self.moves_changed = [0] * 7
 
+    def invalidate_moves(self, cur_player, origin_pos, dest_pos):
+        """
+        Record the two cells changed by the move, and drop the cached moves of the moved checker
+        """
+        if self.move_cache is None:
+            return
+        changed = (1 << self.geometry.cell_index[origin_pos]) | (1 << self.geometry.cell_index[dest_pos])
+        self.moves_changed = [cells | changed for cells in self.moves_changed]
+        self.move_cache[cur_player].pop(origin_pos, None)
 
 
+
+    def zobrist_after(self, cur_player, origin_pos, dest_pos):
+        """
+        Returns what zobrist_hash would be after the move, without making it
+        """
+        origin_cell = origin_pos[0] * BOARD_WIDTH + origin_pos[1]
+        checker_keys = ZOBRIST_CHECKERS[cur_player][self.cell_checkers[origin_cell] - cur_player * NUM_CHECKERS]
+        return self.zobrist_hash ^ checker_keys[origin_cell] \
+                                 ^ checker_keys[dest_pos[0] * BOARD_WIDTH + dest_pos[1]] \
+                                 ^ ZOBRIST_TO_MOVE[self.player_to_move] ^ ZOBRIST_TO_MOVE[(cur_player % 6) + 1]
+
     def place(self, cur_player, origin_pos, dest_pos):
         """
         Makes a move with array indices
         """
-        # Make copy and make move
-        cur_board = np.copy(self.board[:, :, 0])
+        origin_cell = origin_pos[0] * BOARD_WIDTH + origin_pos[1]
+        dest_cell = dest_pos[0] * BOARD_WIDTH + dest_pos[1]
+        if self.cell_checkers[origin_cell] // NUM_CHECKERS != cur_player:
+            raise KeyError(origin_pos)
+
+        # The oldest plane of the ring buffer becomes the current board. The current plane may
+        # have been written through self.board, so its second copy is refreshed before it becomes history.
+        prev_head = self.board_head
+        self.board_head = (prev_head - 1) % BOARD_HIST_MOVES
+        self.planes[prev_head + BOARD_HIST_MOVES] = self.planes[prev_head]
+        cur_board = self.planes[self.board_head]
+        cur_board[...] = self.planes[prev_head]
         cur_board[origin_pos], cur_board[dest_pos] = cur_board[dest_pos], cur_board[origin_pos]
-
-        # Move the checker in both id->positon and position->id lookup
-        for checker_id, checker_pos in self.checkers_pos[cur_player].items():
-            if checker_pos == origin_pos:
-                self.checkers_pos[cur_player][checker_id] = dest_pos
-                break
-
-        self.checkers_id[cur_player][dest_pos] = self.checkers_id[cur_player].pop(origin_pos)
-
-        # Update history
-        self.board = np.concatenate((np.expand_dims(cur_board, axis=2), self.board[:, :, :BOARD_HIST_MOVES - 1]), axis=2)
+        self.view_board()
+
+        # Move the checker in both checker->cell and cell->checker lookup
+        checker = self.cell_checkers[origin_cell]
+        self.cell_checkers[origin_cell] = -1
+        self.cell_checkers[dest_cell] = checker
+        self.checker_cells[checker] = dest_cell
+        checker_id = checker - cur_player * NUM_CHECKERS
+        self.move_progress(cur_player, origin_pos, dest_pos)
+        self.invalidate_moves(cur_player, origin_pos, dest_pos)
+
+        # Update the hash for the moved checker and the player to move
+        next_player = (cur_player % 6) + 1
+        checker_keys = ZOBRIST_CHECKERS[cur_player][checker_id]
+        self.zobrist_hash ^= checker_keys[origin_cell] ^ checker_keys[dest_cell] \
+                           ^ ZOBRIST_TO_MOVE[self.player_to_move] ^ ZOBRIST_TO_MOVE[next_player]
+        self.player_to_move = next_player
+
+        # The oldest slot of the planes becomes the current position
+        if self.input_planes is not None:
+            prev_head = self.planes_head
+            self.planes_head = (prev_head - 1) % BOARD_HIST_MOVES
+            planes = self.input_planes[self.planes_head]
+            planes[...] = self.input_planes[prev_head]
+            planes[cur_player][origin_pos] = 0
+            planes[cur_player][dest_pos] = checker_id + 1
 
         # Record history moves
         if len(self.hist_moves) == TOTAL_HIST_MOVES:
             self.hist_moves.popleft()
         self.hist_moves.append((origin_pos,dest_pos))
 
+        if DEBUG_BOARD:
+            self.check_progress()
         return self.check_win()
 
+    def apply(self, move):
+        """
+        Makes a move in place and returns a token for undo().
+        :type move: (cur_player, origin_pos, dest_pos)
+        """
+        cur_player, origin_pos, dest_pos = move
+        prev_board = self.board[:, :, BOARD_HIST_MOVES - 1].copy()     # The plane place() overwrites
+        dropped_move = self.hist_moves[0] if len(self.hist_moves) == TOTAL_HIST_MOVES else None
+        prev_state = (self.player_to_move, self.zobrist_hash)
+        # place() overwrites the oldest slot of the planes
+        if self.input_planes is not None:
+            prev_state += (self.input_planes[(self.planes_head - 1) % BOARD_HIST_MOVES].copy(),)
+        self.place(cur_player, origin_pos, dest_pos)
+        return move, prev_board, dropped_move, prev_state
+
+    def undo(self, token):
+        """
+        Takes back the move made by apply(), restoring the board exactly
+        """
+        (cur_player, origin_pos, dest_pos), prev_board, dropped_move, prev_state = token
+        # Both copies of the slot, as the restored view may read either of them
+        self.planes[self.board_head] = self.planes[self.board_head + BOARD_HIST_MOVES] = prev_board
+        self.board_head = (self.board_head + 1) % BOARD_HIST_MOVES
+        self.view_board()
+        self.player_to_move, self.zobrist_hash = prev_state[:2]
+        if self.input_planes is not None:
+            self.input_planes[self.planes_head] = prev_state[2]
+            self.planes_head = (self.planes_head + 1) % BOARD_HIST_MOVES
+
+        origin_cell = origin_pos[0] * BOARD_WIDTH + origin_pos[1]
+        dest_cell = dest_pos[0] * BOARD_WIDTH + dest_pos[1]
+        checker = self.cell_checkers[dest_cell]
+        self.cell_checkers[dest_cell] = -1
+        self.cell_checkers[origin_cell] = checker
+        self.checker_cells[checker] = origin_cell
+        self.move_progress(cur_player, dest_pos, origin_pos)
+        self.invalidate_moves(cur_player, dest_pos, origin_pos)
+
+        self.hist_moves.pop()
+        if dropped_move is not None:
+            self.hist_moves.appendleft(dropped_move)
+
+    def clone(self):
+        """
+        Returns a copy of the board that can be moved independently.
+        Much cheaper than copy.deepcopy: the directions and geometry are shared.
+        """
+        other = Board.__new__(Board)
+        other.copy_from(self)
+        return other
+
+    def copy_from(self, other):
+        """
+        Make this board a copy of the other board, as clone() does
+        """
+        self.planes = other.planes.copy()
+        self.board_head = other.board_head
+        self.view_board()
+        self.checker_cells = other.checker_cells[:]
+        self.cell_checkers = other.cell_checkers[:]
+        self.views = None
+        self.hist_moves = deque(other.hist_moves)
+        self.geometry = other.geometry
+        self.move_cache = None if other.move_cache is None else [cached.copy() for cached in other.move_cache]
+        self.moves_changed = other.moves_changed[:]
+        self.player_to_move = other.player_to_move
+        self.zobrist_hash = other.zobrist_hash
+        self.upper_counts, self.lower_counts, self.row_sums = other.upper_counts[:], other.lower_counts[:], other.row_sums[:]
+        self.input_planes = None if other.input_planes is None else other.input_planes.copy()
+        self.planes_head = other.planes_head
+
+    def __getstate__(self):
+        # self.board is a view of the ring buffer and the checker views point at the lookup tables;
+        # both are rebuilt when unpickled. The move cache is emptied, as it is only worth
+        # keeping in the same process.
+        # Only one copy of each history plane is kept, most recent first.
+        state = {name: getattr(self, name) for name in Board.__slots__ if name not in ('board', 'views', 'board_head')}
+        state['planes'] = self.planes[self.board_head:self.board_head + BOARD_HIST_MOVES].tobytes()
+        if self.move_cache is not None:
+            state['move_cache'] = []
+        return state
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            setattr(self, name, value)
+        planes = np.frombuffer(self.planes, dtype='uint8').reshape((BOARD_HIST_MOVES, BOARD_WIDTH, BOARD_HEIGHT))
+        self.planes = np.concatenate((planes, planes))
+        self.board_head = 0
+        self.views = None
+        self.view_board()
+        self.reset_move_cache()
+
+    def to_bytes(self):
+        """
+        Returns the position in the fixed BOARD_BYTES layout, see BOARD_BYTES_FORMAT.
+        The history planes are not stored, from_bytes() rebuilds them from the history moves.
+        """
+        if self.geometry is INITIAL_BOARD.geometry:
+            geometry_kind = 0
+        elif self.geometry.num_cells == BOARD_WIDTH * BOARD_HEIGHT:
+            geometry_kind = 1
+        else:
+            raise ValueError('Only boards on the star or the full board can be converted to bytes')
+
+        cells = [NO_CELL if cell < 0 else cell for cell in self.checker_cells[NUM_CHECKERS:]]
+        moves = [NO_CELL] * (2 * TOTAL_HIST_MOVES)
+        for i, (origin_pos, dest_pos) in enumerate(self.hist_moves):
+            moves[2 * i] = origin_pos[0] * BOARD_WIDTH + origin_pos[1]
+            moves[2 * i + 1] = dest_pos[0] * BOARD_WIDTH + dest_pos[1]
+        return struct.pack(BOARD_BYTES_FORMAT, geometry_kind, self.player_to_move, len(self.hist_moves), *(cells + moves))
+
+    @staticmethod
+    def from_bytes(data, track_planes=TRACK_INPUT_PLANES, cache_moves=MOVE_CACHE):
+        """
+        Returns the Board given the output of to_bytes(). The board k moves ago is the current board
+        with the last k history moves taken back, or empty before the start of the game, as place() keeps it.
+        """
+        fields = struct.unpack(BOARD_BYTES_FORMAT, data)
+        geometry_kind, player_to_move, num_moves = fields[:3]
+        cells = np.array(fields[3:3 + 6 * NUM_CHECKERS], dtype='int32')
+        moves = fields[3 + 6 * NUM_CHECKERS:3 + 6 * NUM_CHECKERS + 2 * num_moves]
+
+        board = Board.__new__(Board)
+        board.planes = np.zeros((BOARD_HIST_MOVES * 2, BOARD_WIDTH, BOARD_HEIGHT), dtype='uint8')
+        board.board_head = 0
+        board.view_board()
+        if geometry_kind == 0:
+            board.planes[0] = EMPTY_STAR
+            board.geometry = INITIAL_BOARD.geometry
+        else:
+            board.geometry = bitboard.geometry_for(board.planes[0])
+
+        # Checkers numbered player * NUM_CHECKERS + checker id, as in the lookup tables
+        checkers = NUM_CHECKERS + np.flatnonzero(cells != NO_CELL)
+        cells = cells[checkers - NUM_CHECKERS]
+        checker_cells = np.full(7 * NUM_CHECKERS, -1, dtype='int16')
+        checker_cells[checkers] = cells
+        cell_checkers = np.full(BOARD_WIDTH * BOARD_HEIGHT, -1, dtype='int8')
+        cell_checkers[cells] = checkers
+        board.checker_cells = array('h', checker_cells.tobytes())
+        board.cell_checkers = array('b', cell_checkers.tobytes())
+        board.views = None
+        board.planes[0].reshape(-1)[cells] = checkers // NUM_CHECKERS
+
+        board.hist_moves = deque((CELLS[moves[i]], CELLS[moves[i + 1]]) for i in range(0, len(moves), 2))
+        for k in range(1, min(num_moves, BOARD_HIST_MOVES - 1) + 1):
+            origin_pos, dest_pos = board.hist_moves[-k]
+            prev_board = board.planes[k]
+            prev_board[...] = board.planes[k - 1]
+            prev_board[origin_pos], prev_board[dest_pos] = prev_board[dest_pos], prev_board[origin_pos]
+        board.planes[BOARD_HIST_MOVES:] = board.planes[:BOARD_HIST_MOVES]
+
+        board.move_cache = [] if cache_moves else None
+        board.reset_move_cache()
+        board.player_to_move = player_to_move
+        board.zobrist_hash = board.compute_zobrist_hash()
+        board.upper_counts, board.lower_counts, board.row_sums = board.compute_progress()
+
+        board.input_planes = None
+        board.planes_head = 0
+        if track_planes:
+            board.reset_input_planes()
+            for k in range(1, min(num_moves, BOARD_HIST_MOVES - 1) + 1):
+                origin_pos, dest_pos = board.hist_moves[-k]
+                player_num = board.planes[k - 1][dest_pos]
+                prev_planes = board.input_planes[k]
+                prev_planes[...] = board.input_planes[k - 1]
+                prev_planes[player_num][origin_pos], prev_planes[player_num][dest_pos] = prev_planes[player_num][dest_pos], 0
+        return board
+
 
 
     def player_progress(self, player_id):
         """
         Given player_id, return number of its checkers having reached the opponent's field.
         """
-        cur_board = self.board[:, :, 0]
-        diag_sign = player_id if player_id == PLAYER_ONE else -1
-        reached_checkers_num = 0
-        for k in range(BOARD_WIDTH - ROWS_OF_CHECKERS, BOARD_WIDTH):
-            diag = cur_board.diagonal(diag_sign * k)
-            for i in diag:
-                if i == player_id:
-                    reached_checkers_num += 1;
-        return reached_checkers_num
+        if player_id == PLAYER_ONE:
+            return self.upper_counts[player_id]
+        return self.lower_counts[player_id]
 
 
 
@@ -314,30 +834,102 @@ class Board:
         """
         Given player_id, return the total forward distance its checkers went through.
         """
-        cur_board = self.board[:, :, 0]
-        checkers_pos = self.checkers_pos[player_id]
-        distance = 0
         if player_id == PLAYER_ONE:
-            distance = PLAYER_ONE_DISTANCE_OFFSET
-            for _, pos in checkers_pos.items():
-                row, _ = board_utils.np_index_to_human_coord(pos)
-                distance -= row
-        else:
-            distance = PLAYER_TWO_DISTANCE_OFFSET
-            for _, pos in checkers_pos.items():
-                row, _ = board_utils.np_index_to_human_coord(pos)
-                distance += row
+            return PLAYER_ONE_DISTANCE_OFFSET - self.row_sums[player_id]
+        return PLAYER_TWO_DISTANCE_OFFSET + self.row_sums[player_id]
 
-        return distance
 
 
+# Board() copies this template of the initial position instead of setting it up again
+INITIAL_BOARD = Board.__new__(Board)
+INITIAL_BOARD.set_initial_state()
+
+# The star without checkers, that Board.from_bytes places the checkers on
+EMPTY_STAR = np.where(INITIAL_BOARD.board[:, :, 0] == bitboard.OFF_BOARD, bitboard.OFF_BOARD, 0).astype('uint8')
+
 
 if __name__ == '__main__':
     """
     Put board.py testcases here
     """
-    board = Board()
+    import random
+    board = Board(track_planes=True, cache_moves=True)
     board.visualise()
+
+    def assert_same_board(board, before):
+        assert np.array_equal(board.board, before.board)
+        assert board.checkers_pos == before.checkers_pos and board.checkers_id == before.checkers_id
+        assert board.hist_moves == before.hist_moves
+        assert board.zobrist_hash == before.zobrist_hash
+        assert board.row_sums == before.row_sums and board.upper_counts == before.upper_counts
+        assert np.array_equal(board.history_planes(range(7)), before.history_planes(range(7)))
+
+    # apply() followed by undo() restores the board exactly
+    for move_num in range(40):
+        player = PLAYER_ONE + move_num % 6
+        before = board.clone()
+        moves = [(start, end) for start, ends in board.get_valid_moves(player).items() for end in ends]
+        start, end = random.choice(moves)
+        token = board.apply((player, start, end))
+        assert board.checkers_id[player][end] == before.checkers_id[player][start]
+        board.undo(token)
+        assert_same_board(board, before)
+        # Also when undoing nested moves, as the search does
+        token = board.apply((player, start, end))
+        next_player = player % 6 + 1
+        middle = board.clone()
+        next_moves = [(s, e) for s, ends in board.get_valid_moves(next_player).items() for e in ends]
+        next_token = board.apply((next_player,) + random.choice(next_moves))
+        board.undo(next_token)
+        assert_same_board(board, middle)
+        board.undo(token)
+        assert_same_board(board, before)
+        # The single move check agrees with the full move sets, on and off the board
+        valid_moves = board.get_valid_moves(player)
+        for checker_pos in board.checkers_pos[player].values():
+            for dest in board.geometry.cells + [(-1, 0), (BOARD_HEIGHT, 3)]:
+                assert board.is_legal_move(player, checker_pos, dest) == (dest in valid_moves[checker_pos])
+        assert not board.is_legal_move(player % 6 + 1, start, end)
+        expected_hash = board.zobrist_after(player, start, end)
+        board.place(player, start, end)
+        # The incremental hash matches the one computed from scratch
+        assert board.zobrist_hash == expected_hash
+        assert board.zobrist_hash == board.compute_zobrist_hash()
+        board.check_progress()
+        # Querying a clone does not consume the pending cache invalidations of the original
+        board.clone().get_valid_moves(player % 6 + 1)
+        # The move cache gives the same moves as generating them from scratch
+        for other_player in range(PLAYER_ONE, PLAYER_SIX + 1):
+            assert board.get_valid_moves(other_player) == \
+                   board.geometry.valid_moves(board.board[:, :, 0], board.checkers_pos[other_player].values())
+            # And the move arrays list the same moves in the same order, with or without the cache
+            from_cells, to_cells, checker_ids = board.get_move_arrays(other_player)
+            assert [(divmod(int(start), BOARD_WIDTH), divmod(int(end), BOARD_WIDTH)) for start, end in zip(from_cells, to_cells)] == \
+                   [(start, end) for start, ends in board.get_valid_moves(other_player).items() for end in ends]
+            assert [board.checkers_id[other_player][divmod(int(start), BOARD_WIDTH)] for start in from_cells] == checker_ids.tolist()
+            uncached = board.geometry.move_arrays(board.board[:, :, 0], board.checkers_pos[other_player])
+            assert all(np.array_equal(a, b) for a, b in zip(uncached, (from_cells, to_cells, checker_ids)))
+        # So do the tracked input planes, and the previous position moved back one slot
+        tracked = board.clone()
+        board.reset_input_planes()
+        assert np.array_equal(tracked.history_planes(range(7))[0], board.history_planes(range(7))[0])
+        assert np.array_equal(tracked.history_planes(range(7))[1], before.history_planes(range(7))[0])
+        board = tracked
+
+    # A pickled board comes back the same, and Board() matches an initial position set up from scratch
+    import pickle
+    unpickled = pickle.loads(pickle.dumps(board))
+    assert np.array_equal(unpickled.board, board.board) and unpickled.checkers_id == board.checkers_id
+    assert unpickled.zobrist_hash == board.zobrist_hash and unpickled.hist_moves == board.hist_moves
+    # So does a board converted to bytes, with its history planes
+    unpacked = Board.from_bytes(board.to_bytes(), track_planes=True)
+    assert len(board.to_bytes()) == BOARD_BYTES and np.array_equal(unpacked.board, board.board)
+    assert unpacked.checkers_pos == board.checkers_pos and unpacked.hist_moves == board.hist_moves
+    assert unpacked.zobrist_hash == board.zobrist_hash and unpacked.row_sums == board.row_sums
+    assert np.array_equal(unpacked.history_planes(range(7)), board.history_planes(range(7)))
+    initial = Board.__new__(Board)
+    initial.set_initial_state()
+    assert np.array_equal(initial.board, Board().board) and initial.checkers_pos == Board().checkers_pos
     # print(board.board[board.checker_pos[PLAYER_ONE][0][0],
     # board.checker_pos[PLAYER_ONE][0][1], 0])
     #
@@ -20,6 +20,9 @@ PLAYER_ONE_DISTANCE_OFFSET = 70
 PLAYER_TWO_DISTANCE_OFFSET = -14
 TOTAL_HIST_MOVES = 16                       # Total number of history moves to keep for checking repetitions
 UNIQUE_DEST_LIMIT = 3
+TRACK_INPUT_PLANES = False                  # Boards keep per-player checker id planes of the last BOARD_HIST_MOVES positions (~6 KB each), MCTS encodes leaves from them
+MOVE_CACHE = False                          # Boards reuse the moves of checkers whose jump chains later moves did not touch
+DEBUG_BOARD = False                         # Check the incremental board counters against a full recount after every move
 
 ''' Dirichlet Noise '''
 DIRICHLET_ALPHA = 0.03                      # Alpha for ~ Dir(), assuming symmetric Dirichlet distribution
@@ -30,6 +33,11 @@ DIR_NOISE_FACTOR = 0.25                     # Weight of Dirichlet noise on root
 INPUT_DIM = (BOARD_WIDTH, BOARD_HEIGHT, BOARD_HIST_MOVES * 2 + 1)
 NUM_FILTERS = 64                            # Default number of filters for conv layers
 NUM_RESIDUAL_BLOCKS = 12                    # Number of residual blocks in the model
+COMPACT_POLICY = False                      # Policy output over the 121 playable cells only, instead of the full 17x17 plane
+FAST_INFERENCE = True                       # Predict through a traced float32 tf.function instead of Keras model.predict
+NUMPY_INFERENCE = False                     # Self-play workers run trained weights with the NumPy engine, without TensorFlow
+QUANTISED_INFERENCE = False                 # AiPlayer and self-play workers predict with the int8 TensorFlow Lite model
+QUANT_CALIBRATION_SIZE = 200                # Stored positions used to calibrate the int8 activation ranges
 
 ''' MCTS and RL '''
 PROGRESS_MOVE_LIMIT = 100
@@ -39,6 +47,12 @@ TREE_TAU = 1
 DET_TREE_TAU = 0.01
 C_PUCT = 3.5
 MCTS_SIMULATIONS = 175
+MCTS_BATCH_SIZE = 1                         # Leaves evaluated per forward pass; > 1 searches with virtual loss
+VIRTUAL_LOSS = 1                            # Visits counted as losses on the path of each pending leaf
+REUSE_TREE = True                           # Keep the searched subtree under the played move for the next search
+TRANSPOSITION_TABLE_SIZE = 100000           # Max positions shared between transpositions in one search; 0 keeps a pure tree
+EVALUATION_CACHE_SIZE = 1000                # Max model evaluations kept per model across searches (~11 KB each, so ~11 MB per model in each process); 0 disables
+TREE_STORE = 'edges'                        # MCTS tree store: 'edges' (Node/Edge objects) or 'arrays' (ArrayNode)
 EPSILON = 1e-5
 TOTAL_MOVES_TILL_TAU0 = 16
 INITIAL_RANDOM_MOVES = 6
@@ -63,6 +77,10 @@ EPOCHS = 5                                 # Training Epochs
 NUM_SELF_PLAY = 180                          # Total number of self plays to generate
 NUM_WORKERS = 12                            # For generating self plays in parallel
 SELF_PLAY_DIFF_MODEL = False
+USE_INFERENCE_SERVER = False                # Workers share one process owning the model instead of loading their own
+INFERENCE_BATCH_SIZE = 64                   # Max positions per forward pass of the inference server
+INFERENCE_MAX_DELAY = 0.005                 # Seconds the server waits to fill a batch after the first request
+LOCKSTEP_GAMES = 1                          # Self-plays advanced together by each worker, batching their leaves; 1 plays one at a time
 
 ''' Greedy-Supervised Training '''
 # G_NUM_GAMES = 60000
@@ -1,4 +1,3 @@
-import copy
 import random
 import numpy as np
 
@@ -13,6 +12,8 @@ from model import Model
 
 class GreedyDataGenerator:
     def __init__(self, randomised=False, random_start=False):
+        if randomised and COMPACT_POLICY:
+            raise ValueError('COMPACT_POLICY cannot encode the moves of randomised boards')
         self.cur_player = GreedyPlayer(player_num=1)
         self.next_player = GreedyPlayer(player_num=2)
         self.randomised = randomised
@@ -41,7 +42,7 @@ class GreedyDataGenerator:
 
         while True:
             best_moves = self.cur_player.decide_move(self.board, verbose=False, training=True)
-            pi = np.zeros(NUM_CHECKERS * BOARD_WIDTH * BOARD_HEIGHT)
+            pi = np.zeros(utils.POLICY_SIZE)
 
             for move in best_moves:
                 start = board_utils.human_coord_to_np_index(move[0])
@@ -50,7 +51,7 @@ class GreedyDataGenerator:
                 neural_net_index = utils.encode_checker_index(checker_id, end)
                 pi[neural_net_index] = 1.0 / len(best_moves)
 
-            play_history.append((copy.deepcopy(self.board), pi))
+            play_history.append((self.board.clone(), pi))
 
             pick_start, pick_end = random.choice(best_moves)
             move_from = board_utils.human_coord_to_np_index(pick_start)
@@ -0,0 +1,111 @@
+import weakref
+import numpy as np
+from collections import OrderedDict
+
+from config import *
+
+
+"""
+Size-bounded LRU cache of model evaluations, keyed by the position's Zobrist
+hash and the player to move.
+
+One cache is kept per model object, so it is shared by every search that uses
+the model: the previous move's search, later moves of the same game and later
+games from the same opening. The key does not cover the history planes of the
+model input, so positions reached through different recent moves share one
+evaluation.
+"""
+
+
+_caches = weakref.WeakKeyDictionary()
+
+
+def position_key(state, cur_player):
+    return state.zobrist_hash, cur_player
+
+
+def cache_for(model, max_size=EVALUATION_CACHE_SIZE):
+    """
+    Returns the EvaluationCache of the model, creating it on first use.
+    Returns None when caching is disabled or there is no model.
+    """
+    if model is None or max_size <= 0:
+        return None
+    cache = _caches.get(model)
+    if cache is None:
+        cache = _caches[model] = EvaluationCache(max_size)
+    return cache
+
+
+def forget(model):
+    """
+    Drop the cached evaluations of the model, e.g. after its weights have changed
+    """
+    cache = _caches.get(model)
+    if cache is not None:
+        cache.clear()
+
+
+class EvaluationCache:
+    def __init__(self, max_size=EVALUATION_CACHE_SIZE):
+        self.max_size = max_size
+        self.entries = OrderedDict()    # Least recently used first
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        """
+        Returns the cached (policy, value) for the key, or None
+        """
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry
+
+    def put(self, key, policy, value):
+        # Policies are kept in float32 to halve the memory of each entry
+        self.entries[key] = (np.asarray(policy, dtype='float32'), float(value))
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups > 0 else 0.
+
+    def memory_bytes(self):
+        """
+        Approximate memory held by the cached policies and values, excluding dict overhead
+        """
+        if not self.entries:
+            return 0
+        policy, _ = next(iter(self.entries.values()))
+        return len(self.entries) * (policy.nbytes + 8)
+
+    def summary(self):
+        return 'Evaluation cache: {} entries, {:.1f} MB, hit rate {:.1f}% ({} hits, {} misses)'.format(
+            len(self.entries), self.memory_bytes() / 2**20, self.hit_rate() * 100, self.hits, self.misses)
+
+
+
+if __name__ == '__main__':
+    """
+    Put evaluation_cache.py testcases here
+    """
+    cache = EvaluationCache(max_size=2)
+    cache.put('a', np.ones(4), 0.5)
+    cache.put('b', np.zeros(4), -0.5)
+    assert cache.get('a')[1] == 0.5         # 'a' is now the most recently used
+    cache.put('c', np.ones(4), 0.)          # So 'b' is evicted
+    assert cache.get('b') is None
+    assert cache.get('c') is not None and len(cache) == 2
+    print(cache.summary())
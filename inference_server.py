@@ -0,0 +1,214 @@
+import time
+import queue
+import random
+import numpy as np
+import multiprocessing as mp
+from multiprocessing.connection import wait
+
+import utils
+from config import *
+
+
+"""
+Shared inference server for self-play workers.
+
+A single server process owns the model(s) and answers evaluation requests
+sent by the workers over pipes. Requests that arrive within INFERENCE_MAX_DELAY
+seconds of the first pending one are evaluated together in one forward pass.
+The workers only run searches, through a RemoteModel in place of the model,
+and never import TensorFlow.
+"""
+
+
+class RemoteModel:
+    def __init__(self, connection, model_index=0, version=0):
+        """
+        Stands in for a Model in a worker process: predictions are sent
+        to the inference server over `connection` and answered there
+        """
+        self.connection = connection
+        self.model_index = model_index
+        self.version = version
+
+    def predict(self, input_board):
+        p, v = self.predict_batch(np.expand_dims(input_board, axis=0))
+        return p[0], v[0]
+
+    def predict_batch(self, input_boards):
+        self.connection.send((self.model_index, np.asarray(input_boards, dtype='float32')))
+        return self.connection.recv()
+
+
+
+def serve(model_paths, connections, max_batch_size=INFERENCE_BATCH_SIZE, max_delay=INFERENCE_MAX_DELAY):
+    """
+    Server process: load the models and answer requests until every worker has
+    closed its connection. Each request is (model index, input boards).
+    """
+    # Only the server loads TensorFlow
+    import tensorflow as tf
+    from model import ResidualCNN
+
+    gpus = tf.config.experimental.list_physical_devices('GPU')
+    if gpus:
+        try:
+            for gpu in gpus:
+                tf.config.experimental.set_memory_growth(gpu, True)
+        except RuntimeError as e:
+            print(e)
+
+    models = []
+    for model_path in model_paths:
+        if QUANTISED_INFERENCE and model_path is not None:
+            from quantise import load_quantised
+            models.append(load_quantised(model_path))
+            continue
+        model = ResidualCNN()
+        if model_path is not None:
+            model.load_weights(model_path)
+        models.append(model)
+    print('Inference server: serving {} model(s) to {} workers'.format(len(models), len(connections)))
+
+    open_connections = list(connections)
+    num_batches = num_positions_served = 0
+    while open_connections:
+        # Collect requests until the batch is full, the deadline passes,
+        # or every worker is waiting for a reply
+        pending = []
+        num_positions = 0
+        deadline = None
+        while open_connections and num_positions < max_batch_size and len(pending) < len(open_connections):
+            timeout = None if deadline is None else max(0., deadline - time.time())
+            ready = wait(open_connections, timeout)
+            if not ready:
+                break
+            for connection in ready:
+                try:
+                    model_index, input_boards = connection.recv()
+                except EOFError:
+                    open_connections.remove(connection)
+                    continue
+                pending.append((connection, model_index, input_boards))
+                num_positions += len(input_boards)
+            if deadline is None and pending:
+                deadline = time.time() + max_delay
+
+        # One forward pass per model over all its pending requests
+        for model_index, model in enumerate(models):
+            requests = [request for request in pending if request[1] == model_index]
+            if not requests:
+                continue
+            p_batch, v_batch = model.predict_batch(np.concatenate([request[2] for request in requests]))
+            p_batch = p_batch.astype('float32')
+            start = 0
+            for connection, _, input_boards in requests:
+                end = start + len(input_boards)
+                connection.send((p_batch[start:end], v_batch[start:end]))
+                start = end
+            num_batches += 1
+            num_positions_served += len(p_batch)
+
+    print('Inference server: {} positions in {} batches ({:.1f} per batch)'
+          .format(num_positions_served, num_batches, num_positions_served / max(num_batches, 1)))
+
+
+
+def selfplay_worker(worker_id, connection, num_self_play, num_models, results):
+    """
+    Worker process: generate self-plays with the models of the inference server
+    and put the list of games on the `results` queue
+    """
+    from selfplay import selfplay, selfplay_lockstep
+
+    # Re-seed the generators: since the RNG may be copied from parent process
+    np.random.seed()        # None seed to source from /dev/urandom
+    random.seed()
+
+    model = RemoteModel(connection, 0)
+    model2 = RemoteModel(connection, 1) if num_models > 1 else None
+
+    if LOCKSTEP_GAMES > 1:
+        games = selfplay_lockstep(model, model2, num_self_play)
+    else:
+        games = (selfplay(model, model2, randomised=False) for i in range(num_self_play))
+
+    worker_result = []
+    for play_history, p1_reward in games:
+        if play_history is not None and p1_reward is not None:
+            worker_result.append((play_history, p1_reward))
+        print('Worker {}: generated {} self-plays'.format(worker_id, len(worker_result)))
+
+    connection.close()
+    results.put(utils.pack_games(worker_result))
+
+
+
+def generate_self_play_with_server(model_path, num_self_play, num_workers, model2_path=None):
+    """
+    Same as train.generate_self_play_in_parallel, with the workers sharing one inference server
+    """
+    # Spawn fresh processes, so the workers do not inherit anything TensorFlow from the parent
+    context = mp.get_context('spawn')
+    model_paths = [model_path] if model2_path is None else [model_path, model2_path]
+
+    pipes = [context.Pipe() for i in range(num_workers)]
+    server = context.Process(target=serve, args=(model_paths, [server_end for server_end, _ in pipes]))
+    server.start()
+
+    results = context.Queue()
+    workers = []
+    work_share = num_self_play // num_workers
+    for i, (_, worker_end) in enumerate(pipes):
+        if i == num_workers - 1:
+            work_share += (num_self_play % num_workers)
+        worker = context.Process(target=selfplay_worker, args=(i + 1, worker_end, work_share, len(model_paths), results))
+        worker.start()
+        workers.append(worker)
+
+    # Only the server and the workers keep their ends open, so the server sees the workers finish
+    for server_end, worker_end in pipes:
+        server_end.close()
+        worker_end.close()
+
+    try:
+        game_list = []
+        num_results = 0
+        while num_results < num_workers:
+            try:
+                packed_games = results.get(timeout=1)
+            except queue.Empty:
+                # A worker or the server that died would leave the others waiting forever
+                failed = [process for process in workers + [server] if process.exitcode not in (None, 0)]
+                if failed:
+                    for process in workers + [server]:
+                        process.terminate()
+                    raise RuntimeError('Self-play process {} exited with code {}'.format(failed[0].name, failed[0].exitcode))
+                continue
+            game_list += utils.unpack_games(packed_games)
+            num_results += 1
+
+    # Exit early if need
+    except KeyboardInterrupt:
+        utils.stress_message('SIGINT caught, exiting')
+        for process in workers + [server]:
+            process.terminate()
+        exit()
+
+    for process in workers + [server]:
+        process.join()
+
+    return game_list
+
+
+
+if __name__ == '__main__':
+    """
+    Put inference_server.py testcases here: time a short self-play run with the server
+    """
+    import sys
+
+    model_path = sys.argv[1] if len(sys.argv) > 1 else None
+    num_workers = int(sys.argv[2]) if len(sys.argv) > 2 else 2
+    start = time.time()
+    games = generate_self_play_with_server(model_path, num_workers, num_workers)
+    print('Generated {} games in {:.1f}s'.format(len(games), time.time() - start))
@@ -1,4 +1,5 @@
 import os
+import tensorflow as tf
 
 from keras import regularizers
 from keras.optimizers import SGD, Adam
@@ -7,21 +8,58 @@ from keras.models import Model as KerasModel
 from keras.layers import Input, Conv2D, Flatten, Dense, BatchNormalization, LeakyReLU, Activation, add
 
 import utils
+import quantise
+import evaluation_cache
 from board import *
 from config import *
 from loss import softmax_cross_entropy_with_logits
 
 
 class Model:
-    def __init__(self, input_dim, filters, version=0):
+    def __init__(self, input_dim, filters, version=0, fast_inference=FAST_INFERENCE):
         self.input_dim = input_dim
         self.filters = filters
         self.version = version
+        self.fast_inference = fast_inference
+        self.inference_fn = None        # Traced on first use
 
     def predict(self, input_board):
-        logits, v = self.model.predict(np.expand_dims(input_board, axis=0).astype('float64'))
-        p = utils.softmax(logits)           # Apply softmax on the logits after prediction
-        return p.squeeze(), v.squeeze()     # Remove the extra batch dimension
+        p, v = self.predict_batch(np.expand_dims(input_board, axis=0))
+        return p[0], v[0]                   # Remove the extra batch dimension
+
+    def predict_batch(self, input_boards):
+        """
+        Evaluate a batch of model inputs with one forward pass
+        """
+        if not self.fast_inference:
+            return self.predict_batch_keras(input_boards)
+
+        if self.inference_fn is None:
+            self.inference_fn = self.build_inference_fn()
+        p, v = self.inference_fn(np.asarray(input_boards, dtype='float32'))
+        return p.numpy(), v.numpy()
+
+    def predict_batch_keras(self, input_boards):
+        """
+        Evaluate a batch of model inputs through Keras `model.predict`
+        """
+        logits, v = self.model.predict(np.asarray(input_boards, dtype='float64'))
+        return utils.softmax(logits), v.reshape(-1)     # Apply softmax on the logits after prediction
+
+    def build_inference_fn(self):
+        """
+        Returns the inference-only forward pass: a float32 tf.function with a fixed
+        input signature, traced once here so that calls skip Keras' predict loop
+        """
+        keras_model = self.model
+
+        @tf.function(input_signature=[tf.TensorSpec(shape=(None,) + tuple(self.input_dim), dtype=tf.float32)])
+        def inference_fn(input_boards):
+            logits, v = keras_model(input_boards, training=False)
+            return tf.nn.softmax(logits), tf.reshape(v, [-1])
+
+        inference_fn(np.zeros((1,) + tuple(self.input_dim), dtype='float32'))     # Warm up
+        return inference_fn
 
     def save(self, save_dir, model_prefix, version):
         if not os.path.exists(save_dir):
@@ -37,6 +75,9 @@ class Model:
         utils.stress_message('Saved model weights "{}{:0>4}-weights" to "{}"'.format(prefix, version, save_dir), True)
 
     def load(self, filepath):
+        evaluation_cache.forget(self)
+        quantise.forget(self)
+        self.inference_fn = None
         self.model = load_model(
             filepath,
             custom_objects={'softmax_cross_entropy_with_logits': softmax_cross_entropy_with_logits}
@@ -44,14 +85,20 @@ class Model:
         return self.model
 
     def load_weights(self, filepath):
+        evaluation_cache.forget(self)
+        quantise.forget(self)
         self.model.load_weights(filepath)
         return self.model   # Return reference to model just in case
 
 
 
 class ResidualCNN(Model):
-    def __init__(self, input_dim=INPUT_DIM, filters=NUM_FILTERS):
+    def __init__(self, input_dim=INPUT_DIM, filters=NUM_FILTERS, policy_size=None):
+        """
+        policy_size defaults to utils.POLICY_SIZE; give it to load weights saved with another policy encoding
+        """
         Model.__init__(self, input_dim, filters)
+        self.policy_size = utils.POLICY_SIZE if policy_size is None else policy_size
         self.model = self.build_model()
 
 
@@ -109,7 +156,7 @@ class ResidualCNN(Model):
         x = BatchNormalization()(x)
         x = Activation('relu')(x)
         x = Flatten()(x)
-        x = Dense(NUM_CHECKERS * BOARD_WIDTH * BOARD_WIDTH,
+        x = Dense(self.policy_size,
                 use_bias=True,
                 activation='linear',
                 kernel_regularizer=regularizer,
@@ -201,6 +248,38 @@ if __name__ == '__main__':
     # for i in range(model_input.shape[2]):
     #     print(model_input[:, :, i])
 
+    import sys
+    import time
+
+    if len(sys.argv) > 1 and sys.argv[1] == 'latency':
+        # Single-position latency of the traced inference path against Keras `model.predict`
+        model = ResidualCNN()
+        input_boards = np.expand_dims(utils.to_model_input(Board(), PLAYER_ONE)[..., :INPUT_DIM[-1]], axis=0)
+        for name, predict_batch in [('keras predict', model.predict_batch_keras), ('traced', model.predict_batch)]:
+            predict_batch(input_boards)      # Warm up
+            start = time.time()
+            for i in range(50):
+                p, v = predict_batch(input_boards)
+            print('{:>13}: {:.2f} ms per call'.format(name, (time.time() - start) / 50 * 1000))
+        p_keras, v_keras = model.predict_batch_keras(input_boards)
+        p_fast, v_fast = model.predict_batch(input_boards)
+        print('Max difference: policy {:.2e}, value {:.2e}'.format(np.abs(p_keras - p_fast).max(), np.abs(v_keras - v_fast).max()))
+        exit()
+
+    if len(sys.argv) > 1 and sys.argv[1] == 'batch':
+        # Per-position evaluation time of single predictions against batched ones
+        model = ResidualCNN()
+        input_board = utils.to_model_input(Board(), PLAYER_ONE)[..., :INPUT_DIM[-1]]
+        for batch_size in [1, 8, 16, 32]:
+            input_boards = np.array([input_board] * batch_size)
+            model.predict_batch(input_boards)        # Warm up
+            start = time.time()
+            for i in range(5):
+                model.predict_batch(input_boards)
+            elapsed = (time.time() - start) / (5 * batch_size)
+            print('Batch size {:>2}: {:.2f} ms per position'.format(batch_size, elapsed * 1000))
+        exit()
+
     from keras.utils.vis_utils import plot_model
     model = ResidualCNN()
     # test for saving
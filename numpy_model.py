@@ -0,0 +1,193 @@
+import h5py
+import numpy as np
+
+import evaluation_cache
+from config import *
+
+
+"""
+Forward passes of ResidualCNN in NumPy, for processes that only evaluate positions.
+
+The weights are read from the .h5 files written by Keras (Model.save_weights or
+Model.save), and every BatchNormalization is folded into the convolution before
+it. Each convolution is then a single GEMM: 1x1 convolutions multiply the
+channels directly, and 3x3 convolutions multiply an im2col matrix of the batch.
+The layer shapes are taken from the weights, so older board sizes load as well.
+"""
+
+
+BN_EPSILON = 1e-3           # Keras default for BatchNormalization
+
+
+def read_h5_weights(filepath):
+    """
+    Returns [(layer name, [weight arrays])] for the layers with weights, in the model's layer order
+    """
+    def decode(name):
+        return name.decode('utf8') if isinstance(name, bytes) else name
+
+    with h5py.File(filepath, 'r') as f:
+        group = f['model_weights'] if 'model_weights' in f else f
+        layers = []
+        for layer_name in map(decode, group.attrs['layer_names']):
+            layer = group[layer_name]
+            weights = [np.array(layer[decode(weight_name)]) for weight_name in layer.attrs['weight_names']]
+            if weights:
+                layers.append((layer_name, weights))
+        return layers
+
+
+def fold_batch_norm(kernel, bias, gamma, beta, moving_mean, moving_variance):
+    """
+    Returns the kernel and bias of the convolution followed by the BatchNormalization
+    """
+    scale = gamma / np.sqrt(moving_variance + BN_EPSILON)
+    kernel = (kernel * scale).astype('float32')
+    bias = ((bias - moving_mean) * scale + beta).astype('float32')
+    return kernel, bias
+
+
+def conv2d(x, kernel, bias, padding='same'):
+    """
+    NHWC convolution with stride 1 as a GEMM, over an im2col matrix for kernels larger than 1x1
+    """
+    kernel_h, kernel_w, in_channels, out_channels = kernel.shape
+    if kernel_h == kernel_w == 1:
+        return gemm(x, kernel.reshape(in_channels, out_channels), bias)
+
+    if padding == 'same':
+        pad_h, pad_w = kernel_h // 2, kernel_w // 2
+        x = np.pad(x, ((0, 0), (pad_h, pad_h), (pad_w, pad_w), (0, 0)))
+    batch, height, width, _ = x.shape
+    out_h, out_w = height - kernel_h + 1, width - kernel_w + 1
+
+    # Columns ordered (row offset, col offset, channel) as in the flattened Keras kernel
+    columns = np.concatenate([x[:, i:i + out_h, j:j + out_w, :]
+                              for i in range(kernel_h) for j in range(kernel_w)], axis=-1)
+    return gemm(columns, kernel.reshape(-1, out_channels), bias)
+
+
+def gemm(x, weights, bias):
+    """
+    Multiply the last axis of `x` by the weight matrix, as one 2D product so that BLAS is used
+    """
+    out = np.dot(x.reshape(-1, x.shape[-1]), weights)
+    out += bias
+    return out.reshape(x.shape[:-1] + (weights.shape[-1],))
+
+
+def relu(x):
+    return np.maximum(x, 0, out=x)
+
+
+class NumpyResidualCNN:
+    def __init__(self, filepath=None, version=0):
+        """
+        Same predict interface as Model, running the forward pass in NumPy.
+        The weights are loaded from `filepath` if given, or later with load_weights.
+        """
+        self.version = version
+        self.input_dim = None
+        if filepath is not None:
+            self.load_weights(filepath)
+
+    def load_weights(self, filepath):
+        evaluation_cache.forget(self)
+        layers = read_h5_weights(filepath)
+
+        # Pair each convolution with the next BatchNormalization of the same width.
+        # The two head convolutions come before their BatchNormalizations in the layer order.
+        convs = []
+        unpaired = []
+        dense = {}
+        for name, weights in layers:
+            if name.startswith('conv2d'):
+                unpaired.append(len(convs))
+                convs.append(weights)
+            elif name.startswith('batch_normalization'):
+                index = next(i for i in unpaired if convs[i][0].shape[-1] == weights[0].shape[0])
+                unpaired.remove(index)
+                convs[index] = fold_batch_norm(*(convs[index] + weights))
+            else:
+                dense[name] = [weight.astype('float32') for weight in weights]
+        assert not unpaired, 'Convolutions without BatchNormalization'
+
+        # Stem, 3 convolutions per residual block, then the value (1 filter) and policy head convolutions
+        self.stem = convs[0]
+        self.blocks = [convs[i:i + 3] for i in range(1, len(convs) - 2, 3)]
+        head_convs = convs[-2:]
+        self.value_conv = next(conv for conv in head_convs if conv[0].shape[-1] == 1)
+        self.policy_conv = next(conv for conv in head_convs if conv[0].shape[-1] != 1)
+
+        self.policy_dense = dense.pop('policy_head')
+        self.value_dense = dense.pop('value_head')
+        self.value_hidden = dense.popitem()[1]     # The only other dense layer
+
+        # The stem is a 'valid' convolution, so the input is larger than the flattened head planes
+        stem_size = self.stem[0].shape[0] - 1
+        head_cells = self.policy_dense[0].shape[0] // self.policy_conv[0].shape[-1]
+        side = int(round(np.sqrt(head_cells))) + stem_size
+        self.input_dim = (side, side, self.stem[0].shape[2])
+        return self
+
+    def forward(self, input_boards):
+        """
+        Returns the policy logits and the values for a batch of model inputs
+        """
+        x = relu(conv2d(np.asarray(input_boards, dtype='float32'), *self.stem, padding='valid'))
+
+        for conv1, conv2, conv3 in self.blocks:
+            y = relu(conv2d(x, *conv1))
+            y = relu(conv2d(y, *conv2))
+            y = conv2d(y, *conv3)
+            x = relu(y + x)
+
+        batch = x.shape[0]
+        policy = relu(conv2d(x, *self.policy_conv)).reshape(batch, -1)
+        logits = np.dot(policy, self.policy_dense[0]) + self.policy_dense[1]
+
+        value = relu(conv2d(x, *self.value_conv)).reshape(batch, -1)
+        value = relu(np.dot(value, self.value_hidden[0]) + self.value_hidden[1])
+        value = np.tanh(np.dot(value, self.value_dense[0]) + self.value_dense[1])
+        return logits, value.reshape(-1)
+
+    def predict(self, input_board):
+        p, v = self.predict_batch(np.expand_dims(input_board, axis=0))
+        return p[0], v[0]
+
+    def predict_batch(self, input_boards):
+        logits, v = self.forward(input_boards)
+        logits -= logits.max(axis=1, keepdims=True)
+        p = np.exp(logits)
+        return p / p.sum(axis=1, keepdims=True), v
+
+
+
+if __name__ == '__main__':
+    """
+    Put numpy_model.py testcases here: compare against Keras on the given weights
+    """
+    import sys
+    import time
+
+    if len(sys.argv) != 2:
+        print('Usage: python3 numpy_model.py <weights .h5>')
+        exit()
+
+    numpy_model = NumpyResidualCNN(sys.argv[1])
+    input_boards = np.random.randint(0, 7, size=(32,) + numpy_model.input_dim).astype('float32')
+
+    for batch_size in [1, 32]:
+        numpy_model.predict_batch(input_boards[:batch_size])
+        start = time.time()
+        for i in range(20):
+            numpy_model.predict_batch(input_boards[:batch_size])
+        print('NumPy batch size {:>2}: {:.2f} ms per call'.format(batch_size, (time.time() - start) / 20 * 1000))
+
+    from model import ResidualCNN
+    keras_model = ResidualCNN(input_dim=numpy_model.input_dim, policy_size=numpy_model.policy_dense[0].shape[1])
+    keras_model.load_weights(sys.argv[1])
+    p_keras, v_keras = keras_model.predict_batch(input_boards)
+    p_numpy, v_numpy = numpy_model.predict_batch(input_boards)
+    print('Max difference: policy {:.2e}, value {:.2e}'.format(np.abs(p_keras - p_numpy).max(), np.abs(v_keras - v_numpy).max()))
+    assert np.allclose(p_keras, p_numpy, atol=1e-4) and np.allclose(v_keras, v_numpy, atol=1e-4)
@@ -5,9 +5,8 @@ import numpy as np
 
 import board_utils
 from config import *
-from model import *
 from board import Board
-from MCTS import Node, MCTS
+from MCTS import MCTS, make_node
 
 
 
@@ -30,10 +29,8 @@ class HumanPlayer:
         os.system('clear')
         board.visualise(cur_player=self.player_num)
 
-        valid_moves = board.get_valid_moves(self.player_num)
-        human_valid_moves = board_utils.convert_np_to_human_moves(valid_moves)
-
         if verbose:
+            human_valid_moves = board_utils.convert_np_to_human_moves(board.get_valid_moves(self.player_num))
             for checker in human_valid_moves:
                 print("Checker {} can move to: {}".format(checker, sorted(human_valid_moves[checker])))
 
@@ -55,7 +52,7 @@ class HumanPlayer:
             from_i, from_j = board_utils.human_coord_to_np_index((human_from_row, human_from_col))
             to_i, to_j = board_utils.human_coord_to_np_index((human_to_row, human_to_col))
 
-            if (from_i, from_j) in valid_moves and (to_i, to_j) in valid_moves[(from_i, from_j)]:
+            if board.is_legal_move(self.player_num, (from_i, from_j), (to_i, to_j)):
                 break
 
             print("\nInvalid Move! Try again!")
@@ -70,71 +67,89 @@ class GreedyPlayer:
         self.stochastic = stochastic
 
     def decide_move(self, board, verbose=False, training=False, total_moves=None):
-        valid_moves = board.get_valid_moves(self.player_num)
-        human_valid_moves = board_utils.convert_np_to_human_moves(valid_moves)
+        from_cells, to_cells, _ = board.get_move_arrays(self.player_num)
+        # Human rows of the moves, as in board_utils.np_index_to_human_coord
+        start_rows = from_cells // BOARD_WIDTH - from_cells % BOARD_WIDTH + BOARD_WIDTH
+        end_rows = to_cells // BOARD_WIDTH - to_cells % BOARD_WIDTH + BOARD_WIDTH
+        dists = end_rows - start_rows           # Evaluate distance by how many steps forward
+        if self.player_num == PLAYER_ONE:       # Revert distance as player1 moves up
+            dists = -dists
 
-        max_dist = float('-inf')
         if self.stochastic:
-            prior = []
-            backward_moves = []
-            forward_moves = []
-            for start in human_valid_moves:
-                for end in human_valid_moves[start]:
-                    dist = end[0] - start[0]
-                    if self.player_num == PLAYER_ONE:
-                        dist = -dist
-                    if dist > 0:
-                        forward_moves.append((start, end))
-                        prior.append(dist)
-                    else:
-                        backward_moves.append((start, end))
-
+            forward_moves = np.flatnonzero(dists > 0)
             if len(forward_moves) == 0:
-                pick_start, pick_end = random.choice(backward_moves)
+                index = random.randrange(len(dists))
             else:
-                prior = np.array(prior) / sum(prior)
-                index = np.random.choice(len(forward_moves), p=prior)
-                pick_start, pick_end = forward_moves[index]
+                prior = dists[forward_moves] / dists[forward_moves].sum()
+                index = forward_moves[np.random.choice(len(forward_moves), p=prior)]
 
         else:
-            best_moves = []
-            for start in human_valid_moves:
-                for end in human_valid_moves[start]:
-                    dist = end[0] - start[0]    # Evaluate distance by how many steps forward
-                    if self.player_num == PLAYER_ONE:    # Revert distance as player1 moves up
-                        dist = -dist
-                    if dist > max_dist:
-                        max_dist = dist
-                        best_moves = [(start, end)]
-                    elif dist == max_dist:
-                        best_moves.append((start, end))
-
+            best_moves = np.flatnonzero(dists == dists.max())
             # When there are many possible moves, pick the one that's the last
-            last_checker, _ = max(best_moves, key=lambda x: (x[0][0] if self.player_num == PLAYER_ONE else -x[0][0]))
+            if self.player_num == PLAYER_ONE:
+                last_row = start_rows[best_moves].max()
+            else:
+                last_row = start_rows[best_moves].min()
             # Take away staying-move, and get all moves that is for the last checker
-            filtered_best_moves = [move for move in best_moves if move[0][0] == last_checker[0]]
+            filtered_best_moves = best_moves[start_rows[best_moves] == last_row]
 
             if training:
-                return filtered_best_moves
+                return [(board_utils.np_index_to_human_coord(divmod(int(from_cells[i]), BOARD_WIDTH)),
+                         board_utils.np_index_to_human_coord(divmod(int(to_cells[i]), BOARD_WIDTH)))
+                        for i in filtered_best_moves]
 
             # Then randomly sample a move
-            pick_start, pick_end = random.choice(filtered_best_moves)
+            index = random.choice(filtered_best_moves)
 
+        pick_start = divmod(int(from_cells[index]), BOARD_WIDTH)
+        pick_end = divmod(int(to_cells[index]), BOARD_WIDTH)
 
         if verbose:
             board.visualise(cur_player = self.player_num)
-            print('GreedyPlayer moved from {} to {}\n'.format(pick_start, pick_end))
+            print('GreedyPlayer moved from {} to {}\n'.format(board_utils.np_index_to_human_coord(pick_start),
+                                                              board_utils.np_index_to_human_coord(pick_end)))
 
-        return board_utils.human_coord_to_np_index(pick_start), \
-               board_utils.human_coord_to_np_index(pick_end)
+        return pick_start, pick_end
 
 
 
 class AiPlayer:
-    def __init__(self, player_num, model, tree_tau):
+    def __init__(self, player_num, model, tree_tau, tree_store=TREE_STORE, reuse_tree=REUSE_TREE, quantised=QUANTISED_INFERENCE):
         self.player_num = player_num
+        if quantised:
+            # Search with the int8 version of the model, converted once per model
+            from quantise import quantised as quantised_model
+            model = quantised_model(model)
         self.model = model
         self.tree_tau = tree_tau
+        self.tree_store = tree_store
+        self.reuse_tree = reuse_tree
+        self.root = None        # Subtree under the last played move, kept for the next search
+
+    def reuse_root(self, board):
+        """
+        Follow the moves played since the last search down the kept subtree.
+        Returns the node for the current board, or None if the subtree does not reach it.
+        """
+        node, self.root = self.root, None
+        if node is None:
+            return None
+
+        num_replies = (self.player_num - node.currPlayer) % 6
+        if num_replies > len(board.hist_moves):
+            return None
+
+        for move_num in range(len(board.hist_moves) - num_replies, len(board.hist_moves)):
+            if node.isLeaf():
+                return None
+            node = node.findChild(*board.hist_moves[move_num])
+            if node is None:
+                return None
+
+        if node.currPlayer != self.player_num or not np.array_equal(node.state.board[:, :, 0], board.board[:, :, 0]):
+            return None
+
+        return node
 
     def decide_move(self, board, verbose=False, total_moves=None):
         """
@@ -146,7 +161,9 @@ class AiPlayer:
             board.visualise(cur_player = self.player_num)
             print('Facing the board above, Ai Version {} is thinking.'.format(self.model.version))
 
-        node = Node(board, self.player_num)
+        node = self.reuse_root(board) if self.reuse_tree else None
+        if node is None:
+            node = make_node(board, self.player_num, self.tree_store)
 
         # Play deterministically when moves reach a certain number
         if total_moves is not None and total_moves > TOTAL_MOVES_TILL_TAU0:
@@ -156,12 +173,17 @@ class AiPlayer:
 
         tree = MCTS(node, self.model, tree_tau=self.tree_tau)
         pi, sampled_edge = tree.search()
+        if self.reuse_tree:
+            self.root = sampled_edge.outNode
 
         if verbose:
             human_fromPos = board_utils.np_index_to_human_coord(sampled_edge.fromPos)
             human_toPos = board_utils.np_index_to_human_coord(sampled_edge.toPos)
-            print('Ai Version {} moved from {} to {}\n'.format(
+            print('Ai Version {} moved from {} to {}'.format(
                 self.model.version, human_fromPos, human_toPos))
+            if tree.cache is not None:
+                print(tree.cache.summary())
+            print()
 
         return sampled_edge.fromPos, sampled_edge.toPos
 
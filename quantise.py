@@ -0,0 +1,178 @@
+import os
+import glob
+import random
+import weakref
+import h5py
+import numpy as np
+import tensorflow as tf
+
+import utils
+from config import *
+from board import Board
+
+
+"""
+Int8 post-training quantisation of ResidualCNN for CPU inference.
+
+The Keras model is converted with TensorFlow Lite: weights and activations are
+quantised to int8, with activation ranges calibrated on stored training positions
+from SAVE_TRAIN_DATA_DIR. Inputs and outputs stay float32, so QuantisedModel is a
+drop-in replacement for Model in MCTS, AiPlayer and the self-play workers.
+"""
+
+
+_quantised = weakref.WeakKeyDictionary()
+
+
+def load_calibration_inputs(input_dim=INPUT_DIM, num_positions=QUANT_CALIBRATION_SIZE, data_dir=SAVE_TRAIN_DATA_DIR):
+    """
+    Returns up to `num_positions` model inputs sampled from the stored training data.
+    Without stored data, positions from random games are used instead.
+    """
+    board_x = []
+    for filename in sorted(glob.glob(os.path.join(data_dir, SAVE_TRAIN_DATA_PREF + '*.h5'))):
+        with h5py.File(filename, 'r') as H:
+            board_x.append(np.array(H['board_x'][..., :input_dim[-1]], dtype='float32'))
+
+    if board_x:
+        board_x = np.concatenate(board_x)
+        sampled_idx = np.random.choice(len(board_x), min(num_positions, len(board_x)), replace=False)
+        return board_x[sampled_idx]
+
+    print('No training data in "{}": calibrating on positions from random games'.format(data_dir))
+    boards = []
+    while len(boards) < num_positions:
+        board = Board()
+        for move in range(random.randint(0, 60)):
+            player = PLAYER_ONE + move % 6
+            valid_moves = [(start, end) for start, ends in board.get_valid_moves(player).items() for end in ends]
+            board.place(player, *random.choice(valid_moves))
+        boards.append(board)
+    return utils.to_model_inputs(boards, [PLAYER_ONE] * len(boards))[..., :input_dim[-1]]
+
+
+def quantise(model, calibration_inputs=None):
+    """
+    Returns the int8 TensorFlow Lite flatbuffer of the model
+    """
+    if calibration_inputs is None:
+        calibration_inputs = load_calibration_inputs(model.input_dim)
+
+    def representative_dataset():
+        for input_board in calibration_inputs:
+            yield [np.expand_dims(input_board, axis=0)]
+
+    converter = tf.lite.TFLiteConverter.from_keras_model(model.model)
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    converter.representative_dataset = representative_dataset
+    return converter.convert()
+
+
+def quantised(model):
+    """
+    Returns the QuantisedModel of the model, converting it on first use
+    """
+    quantised_model = _quantised.get(model)
+    if quantised_model is None:
+        quantised_model = _quantised[model] = QuantisedModel(quantise(model), model.version)
+    return quantised_model
+
+
+def forget(model):
+    """
+    Drop the quantised version of the model, e.g. after its weights have changed
+    """
+    _quantised.pop(model, None)
+
+
+def load_quantised(model_path):
+    """
+    Returns the QuantisedModel of the weights at `model_path`, converted once and
+    kept next to the weights as a .int8.tflite file
+    """
+    quantised_path = os.path.splitext(model_path)[0] + '.int8.tflite'
+    if not os.path.exists(quantised_path):
+        from model import ResidualCNN
+        model = ResidualCNN()
+        model.load_weights(model_path)
+        # Write then rename, as several workers may convert the same weights at once
+        temp_path = '{}.{}'.format(quantised_path, os.getpid())
+        with open(temp_path, 'wb') as f:
+            f.write(quantise(model))
+        os.replace(temp_path, quantised_path)
+        print('Saved quantised model "{}"'.format(quantised_path))
+
+    with open(quantised_path, 'rb') as f:
+        return QuantisedModel(f.read(), utils.find_version_given_filename(model_path))
+
+
+class QuantisedModel:
+    def __init__(self, tflite_model, version=0):
+        """
+        Same predict interface as Model, running an int8 TensorFlow Lite model
+        """
+        self.tflite_model = tflite_model
+        self.version = version
+        self.interpreter = tf.lite.Interpreter(model_content=tflite_model)
+        self.input_index = self.interpreter.get_input_details()[0]['index']
+        self.input_dim = tuple(self.interpreter.get_input_details()[0]['shape'][1:])
+        self.batch_size = None
+
+        # Tell the heads apart by their width: the value head has a single output
+        outputs = self.interpreter.get_output_details()
+        self.value_index = next(output['index'] for output in outputs if output['shape'][-1] == 1)
+        self.policy_index = next(output['index'] for output in outputs if output['shape'][-1] != 1)
+
+    def predict(self, input_board):
+        p, v = self.predict_batch(np.expand_dims(input_board, axis=0))
+        return p[0], v[0]
+
+    def predict_batch(self, input_boards):
+        input_boards = np.asarray(input_boards, dtype='float32')
+        if len(input_boards) != self.batch_size:
+            self.batch_size = len(input_boards)
+            self.interpreter.resize_tensor_input(self.input_index, input_boards.shape)
+            self.interpreter.allocate_tensors()
+
+        self.interpreter.set_tensor(self.input_index, input_boards)
+        self.interpreter.invoke()
+        logits = self.interpreter.get_tensor(self.policy_index)
+        v = self.interpreter.get_tensor(self.value_index)
+        return utils.softmax(logits), v.reshape(-1)
+
+    def __reduce__(self):
+        return QuantisedModel, (self.tflite_model, self.version)
+
+
+
+if __name__ == '__main__':
+    """
+    Put quantise.py testcases here: accuracy drift and speedup against the float model
+    """
+    import sys
+    import time
+    from model import ResidualCNN
+
+    model = ResidualCNN()
+    if len(sys.argv) > 1:
+        model.load_weights(sys.argv[1])
+
+    inputs = load_calibration_inputs(model.input_dim, 2 * QUANT_CALIBRATION_SIZE)
+    calibration_inputs, test_inputs = inputs[:QUANT_CALIBRATION_SIZE], inputs[QUANT_CALIBRATION_SIZE:]
+    quantised_model = QuantisedModel(quantise(model, calibration_inputs))
+
+    p_float, v_float = model.predict_batch(test_inputs)
+    p_int8, v_int8 = quantised_model.predict_batch(test_inputs)
+    print('Policy: max abs diff {:.2e}, top-1 agreement {:.1f}%'.format(
+        np.abs(p_float - p_int8).max(), np.mean(p_float.argmax(axis=1) == p_int8.argmax(axis=1)) * 100))
+    print('Value: mean abs diff {:.2e}, max abs diff {:.2e}'.format(np.abs(v_float - v_int8).mean(), np.abs(v_float - v_int8).max()))
+
+    for batch_size in [1, 16]:
+        timings = []
+        for predict_batch in [model.predict_batch, quantised_model.predict_batch]:
+            predict_batch(test_inputs[:batch_size])     # Warm up
+            start = time.time()
+            for i in range(50):
+                predict_batch(test_inputs[:batch_size])
+            timings.append((time.time() - start) / 50 * 1000)
+        print('Batch size {:>2}: float {:.2f} ms, int8 {:.2f} ms ({:.2f}x)'.format(batch_size, timings[0], timings[1], timings[0] / timings[1]))
@@ -1,85 +1,143 @@
-import copy
 import numpy as np
 import random
 
 import utils
+import evaluation_cache
 from config import *
 from board import Board
-from MCTS import MCTS, Node
+from MCTS import MCTS, make_node, evaluate_batch
 
 
-def selfplay(model1, model2=None, randomised=False):
+def selfplay(model1, model2=None, randomised=False, tree_store=TREE_STORE):
     '''
     Generate an agent self-play given two models
     TODO: if `randomised`, randomise starting board state
     '''
-    if model2 is None:
-        model2 = model1
-
-    # player_progresses = [0, 0]
-    player_progresses = [0] * 6
-    player_turn = 0
-    num_useless_moves = 0
-    play_history = []
-    tree_tau = TREE_TAU
-
-    board = Board(randomised=randomised)
-    root = Node(board, PLAYER_ONE)          # initial game state
-    use_model1 = True
-
-    while True:
-        model = model1 if use_model1 else model2
-
-        if len(root.state.hist_moves) < INITIAL_RANDOM_MOVES:
-            root = make_random_move(root)
+    game = SelfPlayGame(model1, model2, randomised, tree_store)
+    while not game.finished:
+        if game.in_opening():
+            game.root = make_random_move(game.root)
         else:
             # Use Current model to make a move
-            root = make_move(root, model, tree_tau, play_history)
-
-        assert root.isLeaf()
-
-        hist_moves = root.state.hist_moves
+            game.root = make_move(game.root, game.model(), game.tree_tau, game.play_history, reuse_tree=game.reuse_tree)
+        game.end_move()
+
+    return game.result
+
+
+class SelfPlayGame:
+    def __init__(self, model1, model2=None, randomised=False, tree_store=TREE_STORE):
+        '''
+        State and bookkeeping of one self-play game, shared by the drivers that
+        play its moves: `selfplay` for one game, `selfplay_lockstep` for many
+        '''
+        if model2 is None:
+            model2 = model1
+
+        self.model1 = model1
+        self.model2 = model2
+        if randomised and COMPACT_POLICY:
+            raise ValueError('COMPACT_POLICY cannot encode the moves of randomised boards')
+        self.randomised = randomised
+        # The tree can only be kept when both sides search with the same model
+        self.reuse_tree = REUSE_TREE and model1 is model2
+
+        # player_progresses = [0, 0]
+        self.player_progresses = [0] * 6
+        self.player_turn = 0
+        self.num_useless_moves = 0
+        self.play_history = []
+        self.tree_tau = TREE_TAU
+
+        board = Board(randomised=randomised)
+        self.root = make_node(board, PLAYER_ONE, tree_store)     # initial game state
+        self.use_model1 = True
+
+        self.finished = False
+        self.result = None      # (play history, p1 reward) once finished; (None, None) if discarded
+
+        self.tree = None        # Search in progress, for the drivers that interleave games
+        self.num_sims = 0
+
+    def model(self):
+        return self.model1 if self.use_model1 else self.model2
+
+    def in_opening(self):
+        # The opening moves are random and not searched
+        return len(self.root.state.hist_moves) < INITIAL_RANDOM_MOVES
+
+    def start_search(self):
+        '''
+        Returns the search in progress, or plays the random opening moves and
+        starts the search for the next move. Returns None once the game is finished.
+        '''
+        while self.tree is None and not self.finished:
+            if self.in_opening():
+                self.root = make_random_move(self.root)
+                self.end_move()
+            else:
+                self.tree = MCTS(self.root, self.model(), tree_tau=self.tree_tau)
+                self.num_sims = 0
+                if not self.root.isLeaf():
+                    # Kept from the last search: add Dirichlet noise to the prior probs at once
+                    self.tree.addDirichletNoise()
+        return self.tree
+
+    def end_move(self):
+        '''
+        Update the game after `root` has been moved to the new position,
+        setting `finished` and `result` when the game is over
+        '''
+        hist_moves = self.root.state.hist_moves
         cur_player_hist_moves = [hist_moves[i] for i in range(len(hist_moves) - 1, -1, -2)]
         history_dests = set([move[1] for move in cur_player_hist_moves])
 
         # If limited destinations exist in the past moves, then there is some kind of repetition
         if len(cur_player_hist_moves) * 2 >= TOTAL_HIST_MOVES and len(history_dests) <= UNIQUE_DEST_LIMIT:
             print('Repetition detected: stopping and discarding game')
-            return None, None
+            self.finish(None, None)
+            return
 
         # Evaluate player progress for stopping
-        progress_evaluated = root.state.player_progress(player_turn + 1)
-        if progress_evaluated > player_progresses[player_turn]:
-            num_useless_moves = int(num_useless_moves * (NUM_CHECKERS - 1) / NUM_CHECKERS)
-            player_progresses[player_turn] = progress_evaluated
+        progress_evaluated = self.root.state.player_progress(self.player_turn + 1)
+        if progress_evaluated > self.player_progresses[self.player_turn]:
+            self.num_useless_moves = int(self.num_useless_moves * (NUM_CHECKERS - 1) / NUM_CHECKERS)
+            self.player_progresses[self.player_turn] = progress_evaluated
         else:
-            num_useless_moves += 1
+            self.num_useless_moves += 1
 
         # Change player
         # player_turn = 1 - player_turn
-        player_turn = (player_turn + 1) % 6  # Cycle through six players
-        use_model1 = not use_model1
+        self.player_turn = (self.player_turn + 1) % 6  # Cycle through six players
+        self.use_model1 = not self.use_model1
 
         # Change TREE_TAU to very small if game has certain progress so actions are deterministic
-        if len(play_history) + INITIAL_RANDOM_MOVES > TOTAL_MOVES_TILL_TAU0:
-            if tree_tau == TREE_TAU:
-                print('selfplay: Changing tree_tau to {} as total number of moves is now {}'.format(DET_TREE_TAU, len(play_history)))
-            tree_tau = DET_TREE_TAU
+        if len(self.play_history) + INITIAL_RANDOM_MOVES > TOTAL_MOVES_TILL_TAU0:
+            if self.tree_tau == TREE_TAU:
+                print('selfplay: Changing tree_tau to {} as total number of moves is now {}'.format(DET_TREE_TAU, len(self.play_history)))
+            self.tree_tau = DET_TREE_TAU
 
-        if root.state.check_win():
+        if self.root.state.check_win():
             print('END GAME REACHED')
-            break
+            cache = evaluation_cache.cache_for(self.model1)
+            if cache is not None:
+                print(cache.summary())
+
+            if self.randomised:
+                # Discard the first `BOARD_HIST_MOVES` as the history is not enough
+                self.finish(self.play_history[BOARD_HIST_MOVES:], utils.get_p1_winloss_reward(self.root.state))
+            else:
+                self.finish(self.play_history, utils.get_p1_winloss_reward(self.root.state))
+            return
 
         # Stop (and discard) the game if it's nonsense
-        if num_useless_moves >= PROGRESS_MOVE_LIMIT:
+        if self.num_useless_moves >= PROGRESS_MOVE_LIMIT:
             print('Game stopped by reaching progress move limit; Game Discarded')
-            return None, None
+            self.finish(None, None)
 
-    if randomised:
-        # Discard the first `BOARD_HIST_MOVES` as the history is not enough
-        return play_history[BOARD_HIST_MOVES:], utils.get_p1_winloss_reward(root.state)
-    else:
-        return play_history, utils.get_p1_winloss_reward(root.state)
+    def finish(self, play_history, p1_reward):
+        self.finished = True
+        self.result = (play_history, p1_reward)
 
 
 def make_random_move(root):
@@ -99,41 +157,111 @@ def make_random_move(root):
         random_start = random.choice(list(valid_actions.keys()))
     random_end = random.choice(valid_actions[random_start])
 
-    next_state = copy.deepcopy(cur_state)
-    next_state.place(player, random_start, random_end)
+    # No copy needed: the random opening moves are not recorded in the play history
+    cur_state.place(player, random_start, random_end)
     # new_player = PLAYER_ONE + PLAYER_TWO - player
     new_player = (player % 6) + 1  # Cycle through six players
 
-    return Node(next_state, new_player)
+    return type(root)(cur_state, new_player)
 
 
-def make_move(root, model, tree_tau, play_history):
+def make_move(root, model, tree_tau, play_history, reuse_tree=REUSE_TREE):
     '''
     Given a current board state, perform tree search
     and make a move
     (Code inside original while loop of selfplay())
     '''
-    assert root.isLeaf()
     tree = MCTS(root, model, tree_tau=tree_tau)
 
-    # Make the first expansion to possible next states
-    tree.expandAndBackUp(tree.root, breadcrumbs=[])     # breadcrumbs=[] as root has empth path back to root
-    assert len(tree.root.edges) > 0 # as root has been expanded
+    # Make the first expansion to possible next states, unless the root was kept from the last search
+    if tree.root.isLeaf():
+        tree.expandAndBackUp(tree.root, breadcrumbs=[])     # breadcrumbs=[] as root has empth path back to root
+    assert not tree.root.isLeaf()   # as root has been expanded
 
     # Add Dirichlet noise to prior probs at the root to ensure all moves may be tried
-    dirichlet_noise = np.random.dirichlet(np.ones(len(tree.root.edges)) * DIRICHLET_ALPHA)
-    for i in range(len(tree.root.edges)):
-        tree.root.edges[i].stats['P'] *= (1. - DIR_NOISE_FACTOR)
-        tree.root.edges[i].stats['P'] += DIR_NOISE_FACTOR * dirichlet_noise[i]
+    tree.addDirichletNoise()
 
     # Decide next move from the root with 1 level of prior probability
     pi, sampled_edge = tree.search()
+    return play_searched_move(tree, pi, sampled_edge, play_history, reuse_tree)
+
+
+def play_searched_move(tree, pi, sampled_edge, play_history, reuse_tree=REUSE_TREE):
+    '''
+    Record the search result in the play history and return the root for the next move
+    '''
     play_history.append((tree.root.state, pi))
 
     outNode = sampled_edge.outNode
-    outNode.edges.clear()
+    if reuse_tree:
+        # Keep the subtree under the played move, with the visits already spent on it
+        return outNode
+
+    # The rest of the tree is dropped, so the chosen child's state can be reused as is
+    return type(tree.root)(outNode.state, outNode.currPlayer)   # root for next iteration
 
-    return copy.deepcopy(outNode) # root for next iteration
+
+def selfplay_lockstep(model1, model2=None, num_games=NUM_SELF_PLAY, num_parallel=LOCKSTEP_GAMES, randomised=False,
+                      tree_store=TREE_STORE):
+    '''
+    Generate `num_games` self-plays, advancing up to `num_parallel` games together.
+    At each step every game contributes the pending leaves of its search (up to
+    MCTS_BATCH_SIZE), and the leaves of all games are evaluated with one forward
+    pass per model. A finished game is replaced by a new one so the batch stays full.
+    Returns the list of (play history, p1 reward) of the games, in order of completion.
+    '''
+    results = []
+    games = []
+    num_started = 0
+
+    while games or num_started < num_games:
+        # Keep the batch full
+        while len(games) < num_parallel and num_started < num_games:
+            games.append(SelfPlayGame(model1, model2, randomised, tree_store))
+            num_started += 1
+
+        # Collect the pending leaves of every game, grouped by model
+        requests = {}
+        for game in games:
+            tree = game.start_search()
+            if tree is None:
+                continue
+
+            expanding_root = tree.root.isLeaf()
+            if expanding_root:
+                # First expansion of the root, not counted as a simulation
+                num_run, pending, leafNodes = tree.collectLeaves(1)
+            else:
+                num_run, pending, leafNodes = tree.collectLeaves(min(tree.batch_size, tree.num_itr - game.num_sims))
+                game.num_sims += num_run
+            if pending:
+                model, cache, model_requests = requests.setdefault(id(tree.model), (tree.model, tree.cache, []))
+                model_requests.append((game, expanding_root, pending, leafNodes))
+
+        # One forward pass per model over the leaves of all games
+        for model, cache, model_requests in requests.values():
+            leafNodes = [leafNode for _, _, _, leaves in model_requests for leafNode in leaves]
+            p_evaluated, v_evaluated = evaluate_batch(model, leafNodes, cache)
+            start = 0
+            for game, expanding_root, pending, leaves in model_requests:
+                end = start + len(leaves)
+                game.tree.completeLeaves(pending, leaves, p_evaluated[start:end], v_evaluated[start:end])
+                if expanding_root:
+                    game.tree.addDirichletNoise()
+                start = end
+
+        # Play the moves of the games whose search is complete
+        for game in games:
+            if game.tree is not None and game.num_sims >= game.tree.num_itr:
+                pi, sampled_edge = game.tree.choose()
+                game.root = play_searched_move(game.tree, pi, sampled_edge, game.play_history, game.reuse_tree)
+                game.tree = None
+                game.end_move()
+
+        results += [game.result for game in games if game.finished]
+        games = [game for game in games if not game.finished]
+
+    return results
 
 
 # def get_reward(board):
@@ -4,15 +4,16 @@ import sys
 import h5py
 import datetime
 import threading
+import random
 import argparse
+import numpy as np
 import multiprocessing as mp
-import tensorflow as tf
 
 import utils
 from config import *
-from model import *
 from MCTS import *
-from selfplay import selfplay
+from selfplay import selfplay, selfplay_lockstep
+from inference_server import generate_self_play_with_server
 
 
 """
@@ -27,55 +28,77 @@ This file coordinates training procedure, including:
 
 
 def generate_self_play(worker_id, model_path, num_self_play, model2_path=None):
-    # Load the current model in the worker only for prediction and set GPU limit
-    # tf_config = tf.ConfigProto()
-    # tf_config.gpu_options.allow_growth = True
-    # session = tf.Session(config=tf_config)
-    # set_session(session=session)
-
-    gpus = tf.config.experimental.list_physical_devices('GPU')
-    if gpus:
-        try:
-            for gpu in gpus:
-                tf.config.experimental.set_memory_growth(gpu, True)
-        except RuntimeError as e:
-            print(e)
+    if NUMPY_INFERENCE and model_path is not None:
+        # Run the trained weights in NumPy: the worker never loads TensorFlow
+        from numpy_model import NumpyResidualCNN as ResidualCNN
+    else:
+        # Load the current model in the worker only for prediction and set GPU limit
+        import tensorflow as tf
+        from model import ResidualCNN
+
+        # tf_config = tf.ConfigProto()
+        # tf_config.gpu_options.allow_growth = True
+        # session = tf.Session(config=tf_config)
+        # set_session(session=session)
+
+        gpus = tf.config.experimental.list_physical_devices('GPU')
+        if gpus:
+            try:
+                for gpu in gpus:
+                    tf.config.experimental.set_memory_growth(gpu, True)
+            except RuntimeError as e:
+                print(e)
 
     # Re-seed the generators: since the RNG was copied from parent process
     np.random.seed()        # None seed to source from /dev/urandom
     random.seed()
 
     # Decide what model to use
-    model = ResidualCNN()
     model2 = None
-    if model_path is not None:
-        print('Worker {}: loading model "{}"'.format(worker_id, model_path))
-        model.load_weights(model_path)
-        print('Worker {}: model load successful'.format(worker_id))
-
-        if model2_path is not None:
-            print('Worker {}: loading 2nd model "{}"'.format(worker_id, model2_path))
-            model2 = ResidualCNN()
-            model2.load_weights(model2_path)
-            print('Worker {}: 2nd model load successful'.format(worker_id))
-        else:
-            print ('Worker {}: Model2 is None; using Model1 to generate selfplays'.format(worker_id))
+    if QUANTISED_INFERENCE and model_path is not None:
+        # The quantised models are loaded directly, without building the Keras models first
+        from quantise import load_quantised
+        model = load_quantised(model_path)
+        model2 = load_quantised(model2_path) if model2_path is not None else None
+        print('Worker {}: using int8 quantised model(s)'.format(worker_id))
     else:
-        print('Worker {}: using un-trained model'.format(worker_id))
+        model = ResidualCNN()
+        if model_path is not None:
+            print('Worker {}: loading model "{}"'.format(worker_id, model_path))
+            model.load_weights(model_path)
+            print('Worker {}: model load successful'.format(worker_id))
+
+            if model2_path is not None:
+                print('Worker {}: loading 2nd model "{}"'.format(worker_id, model2_path))
+                model2 = ResidualCNN()
+                model2.load_weights(model2_path)
+                print('Worker {}: 2nd model load successful'.format(worker_id))
+            else:
+                print ('Worker {}: Model2 is None; using Model1 to generate selfplays'.format(worker_id))
+        else:
+            print('Worker {}: using un-trained model'.format(worker_id))
 
     # Worker start generating self plays according to their workload
+    if LOCKSTEP_GAMES > 1:
+        games = selfplay_lockstep(model, model2, num_self_play)
+    else:
+        games = (selfplay(model, model2, randomised=False) for i in range(num_self_play))
+
     worker_result = []
-    for i in range(num_self_play):
-        play_history, p1_reward = selfplay(model, model2, randomised=False)
+    for play_history, p1_reward in games:
         if play_history is not None and p1_reward is not None:
             worker_result.append((play_history, p1_reward))
         print('Worker {}: generated {} self-plays'.format(worker_id, len(worker_result)))
 
-    return worker_result
+    # Boards as bytes are much cheaper to send back than pickled Board objects
+    return utils.pack_games(worker_result)
 
 
 
 def generate_self_play_in_parallel(model_path, num_self_play, num_workers, model2_path=None):
+    if USE_INFERENCE_SERVER:
+        return generate_self_play_with_server(model_path, num_self_play, num_workers, model2_path)
+
     # Process pool for parallelism
     process_pool = mp.Pool(processes=num_workers)
     work_share = num_self_play // num_workers
@@ -96,7 +119,7 @@ def generate_self_play_in_parallel(model_path, num_self_play, num_workers, model
         # Join processes and summarise the generated final list of games
         game_list = []
         for result in worker_results:
-            game_list += result.get()
+            game_list += utils.unpack_games(result.get())
 
         process_pool.close()
 
@@ -115,6 +138,9 @@ def generate_self_play_in_parallel(model_path, num_self_play, num_workers, model
 
 def train(model_path, board_x, pi_y, v_y, data_retention, version):
     # Set TF gpu limit
+    import tensorflow as tf
+    from model import ResidualCNN
+
     # tf_config = tf.ConfigProto()
     # tf_config.gpu_options.allow_growth = True
     # session = tf.Session(config=tf_config)
@@ -161,6 +187,8 @@ def train(model_path, board_x, pi_y, v_y, data_retention, version):
 
 def evaluate(worker_id, best_model, cur_model, num_games):
     # Load the current model in the worker only for prediction and set GPU limit
+    import tensorflow as tf
+
     # tf_config = tf.ConfigProto()
     # tf_config.gpu_options.allow_growth = True
     # session = tf.Session(config=tf_config)
@@ -354,7 +382,7 @@ def combine_prev_iters_train_data(board_x, pi_y, v_y, iteration_count):
 
             with h5py.File(filename, 'r') as H:
                 all_board_x.append(np.copy(H['board_x']))
-                all_pi_y.append(np.copy(H['pi_y']))
+                all_pi_y.append(utils.match_policy_encoding(np.copy(H['pi_y'])))
                 all_v_y.append(np.copy(H['v_y']))
 
     if len(all_board_x) > 0 and len(all_pi_y) > 0 and len(all_v_y) > 0:
@@ -6,7 +6,21 @@ import numpy as np
 from sys import getsizeof
 from collections import Mapping, Container
 
+import bitboard
 from config import *
+from board import Board, CELLS
+
+
+# Playable cells of the standard star board, in row-major order; the compact policy indexes only these
+STAR_GEOMETRY = bitboard.geometry_for(Board().board[:, :, 0])
+POLICY_CELLS = STAR_GEOMETRY.num_cells if COMPACT_POLICY else BOARD_WIDTH * BOARD_HEIGHT
+POLICY_SIZE = NUM_CHECKERS * POLICY_CELLS       # Length of the model's policy output
+
+# Offset of each cell (row * BOARD_WIDTH + col) in a checker's block of the policy output, -1 if not encoded
+POLICY_CELL_OFFSETS = np.arange(BOARD_WIDTH * BOARD_HEIGHT)
+if COMPACT_POLICY:
+    POLICY_CELL_OFFSETS = np.full(BOARD_WIDTH * BOARD_HEIGHT, -1)
+    POLICY_CELL_OFFSETS[STAR_GEOMETRY.flat_cells] = np.arange(STAR_GEOMETRY.num_cells)
 
 
 def find_version_given_filename(filename):
@@ -59,22 +73,36 @@ def save_train_data(board_x, pi_y, v_y, version):
 
 def convert_to_train_data(self_play_games):
     ''' Return python lists containing training data '''
-    board_x, pi_y, v_y = [], [], []
+    boards, players, pi_y, v_y = [], [], [], []
     for game in self_play_games:
         history, reward = game
         curr_player = PLAYER_ONE
         for board, pi in history:
-            board_x.append(to_model_input(board, curr_player))
+            boards.append(board)
+            players.append(curr_player)
             pi_y.append(pi)
             v_y.append(reward)
             reward = -reward
             curr_player = (curr_player % 6) + 1
 
-
+    # Encode all positions at once
+    board_x = list(to_model_inputs(boards, players))
     return board_x, pi_y, v_y
 
 
 
+def pack_games(self_play_games):
+    ''' Convert the boards of the games to bytes, for sending them between processes '''
+    return [([(board.to_bytes(), pi) for board, pi in history], reward) for history, reward in self_play_games]
+
+
+
+def unpack_games(packed_games):
+    ''' Convert the games from pack_games back to boards '''
+    return [([(Board.from_bytes(data), pi) for data, pi in history], reward) for history, reward in packed_games]
+
+
+
 def augment_train_data(board_x, pi_y, v_y):
     ''' Augment training data by horizontal flipping of the board '''
     new_board_x, new_pi_y, new_v_y = [], [], []
@@ -202,13 +230,85 @@ def to_model_input(board, cur_player):
 
 
 
+def to_model_inputs(boards, cur_players, out=None):
+    """
+    Batched to_model_input over a list of boards and their players to play.
+    Output:
+        N x 17 x 17 x 7 float32, equal to the first 7 channels of to_model_input for each board.
+        Written into `out` if given, a preallocated float32 buffer of at least N inputs.
+    """
+    num_boards = len(boards)
+    num_channels = INPUT_DIM[-1]
+    planes = np.zeros((num_boards, num_channels, BOARD_WIDTH * BOARD_HEIGHT), dtype='float32')
+
+    # Checker id + 1 on each cell, for the current player (plane 0) and the opponent (plane 1)
+    plane_index, cells, checker_ids = [], [], []
+    for i, (board, cur_player) in enumerate(zip(boards, cur_players)):
+        for side, player in enumerate((cur_player, PLAYER_ONE + PLAYER_TWO - cur_player)):
+            positions = board.checkers_pos[player]
+            plane_index += [i * num_channels + side] * len(positions)     # Plane `side` of board i, once per checker
+            cells += [row * BOARD_WIDTH + col for row, col in positions.values()]
+            checker_ids += positions.keys()
+    planes.reshape(-1, BOARD_WIDTH * BOARD_HEIGHT)[plane_index, cells] = np.array(checker_ids) + 1
+
+    # Undo the history moves one step at a time, in all boards at once.
+    # As in to_model_input, the moves are taken to alternate between the opponent and the current player.
+    active = list(range(num_boards))
+    for channel in range(1, BOARD_HIST_MOVES):
+        active = [i for i in active if boards[i].board[:, :, channel].any()]
+        if not active:
+            break
+        moves = [boards[i].hist_moves[len(boards[i].hist_moves) - channel] for i in active]
+        orig_cells = [orig[0] * BOARD_WIDTH + orig[1] for orig, _ in moves]
+        dest_cells = [dest[0] * BOARD_WIDTH + dest[1] for _, dest in moves]
+        moved_plane = channel * 2 + channel % 2     # Opponent first
+
+        # Copy the previous planes, then swap the origin and destination cells of the moved player's plane
+        planes[active, channel * 2:channel * 2 + 2] = planes[active, channel * 2 - 2:channel * 2]
+        # active * 2 lists each board twice, pairing it with its origin cell in the first half and its destination in the second
+        planes[active * 2, moved_plane, orig_cells + dest_cells] = planes[active * 2, moved_plane, dest_cells + orig_cells]
+
+    # Last channel is all 1 if player 2 is to play
+    planes[[player == PLAYER_TWO for player in cur_players], BOARD_HIST_MOVES * 2] = 1
+
+    if out is None:
+        out = np.empty((num_boards,) + INPUT_DIM, dtype='float32')
+    model_inputs = out[:num_boards]
+    model_inputs[...] = planes.reshape(num_boards, num_channels, BOARD_WIDTH, BOARD_HEIGHT).transpose(0, 2, 3, 1)
+    return model_inputs
+
+
+
+def tracked_model_inputs(boards, cur_players, out=None):
+    """
+    to_model_inputs for boards that track their input planes: the checker id planes are
+    copied from each board's history instead of rebuilt. The history planes are the actual
+    past positions, which is what to_model_input reconstructs when players alternate as it assumes.
+    """
+    num_boards = len(boards)
+    if out is None:
+        out = np.empty((num_boards,) + INPUT_DIM, dtype='float32')
+    model_inputs = out[:num_boards]
+
+    histories = np.stack([board.history_planes([cur_player, PLAYER_ONE + PLAYER_TWO - cur_player])
+                          for board, cur_player in zip(boards, cur_players)])
+    histories = histories.reshape(num_boards, BOARD_HIST_MOVES * 2, BOARD_WIDTH, BOARD_HEIGHT)
+    model_inputs[..., :BOARD_HIST_MOVES * 2] = histories.transpose(0, 2, 3, 1)
+
+    # Last channel is all 1 if player 2 is to play
+    model_inputs[..., BOARD_HIST_MOVES * 2] = (np.asarray(cur_players) == PLAYER_TWO)[:, None, None]
+    return model_inputs
+
+
+
 def encode_checker_index(checker_id, coord):
     """
     Convert a checker and its destination
     to the model's output encoding.
+    With COMPACT_POLICY, destinations are numbered over the playable cells only.
     """
-    region = checker_id * BOARD_WIDTH * BOARD_HEIGHT # get the element-block in the model's output
-    offset = coord[0] * BOARD_WIDTH + coord[1]          # offset in this region
+    region = checker_id * POLICY_CELLS                  # get the element-block in the model's output
+    offset = int(policy_cell_offsets(coord[0] * BOARD_WIDTH + coord[1]))     # offset in this region
     return region + offset
 
 
@@ -218,13 +318,108 @@ def decode_checker_index(model_output_index):
     Convert the index in the model's output vector
     to the checker number and its destination on board
     """
-    checker_id = model_output_index // (BOARD_WIDTH * BOARD_HEIGHT)
-    offset = model_output_index % (BOARD_WIDTH * BOARD_HEIGHT)
+    checker_id = model_output_index // POLICY_CELLS
+    offset = model_output_index % POLICY_CELLS
+    if COMPACT_POLICY:
+        return checker_id, STAR_GEOMETRY.cells[offset]
     dest = offset // BOARD_WIDTH, offset % BOARD_WIDTH
     return checker_id, dest
 
 
 
+def policy_cell_offsets(cells):
+    """
+    Returns the offsets of the given cells (row * BOARD_WIDTH + col) in a checker's block of the
+    policy output. Moves off the star, as on randomised boards, have no encoding with COMPACT_POLICY.
+    """
+    offsets = POLICY_CELL_OFFSETS[cells]
+    assert np.all(offsets >= 0), 'COMPACT_POLICY cannot encode moves off the star board'
+    return offsets
+
+
+
+def policy_indices(checker_ids, destinations):
+    """
+    Vectorised encode_checker_index: the policy output indices of the given checker ids
+    and (row, col) destinations
+    """
+    destinations = np.asarray(destinations, dtype='int64').reshape(-1, 2)
+    cells = destinations[:, 0] * BOARD_WIDTH + destinations[:, 1]
+    return np.asarray(checker_ids, dtype='int64') * POLICY_CELLS + policy_cell_offsets(cells)
+
+
+
+def legal_moves(board, cur_player):
+    """
+    Returns the valid moves [(from, to)] of the player and their indices in the policy output
+    """
+    from_cells, to_cells, _, indices = legal_move_arrays(board, cur_player)
+    assert np.all(indices >= 0), 'Invalid policy index for a legal move'
+    moves = [(CELLS[start], CELLS[end]) for start, end in zip(from_cells.tolist(), to_cells.tolist())]
+    return moves, indices
+
+
+
+def legal_move_arrays(board, cur_player):
+    """
+    Returns the valid moves of the player as int16 arrays (from cells, to cells, checker ids,
+    policy indices), see Board.get_move_arrays
+    """
+    from_cells, to_cells, checker_ids = board.get_move_arrays(cur_player)
+    indices = (checker_ids * POLICY_CELLS + policy_cell_offsets(to_cells)).astype('int16')
+    return from_cells, to_cells, checker_ids, indices
+
+
+
+def legal_policy(p_evaluated, indices):
+    """
+    Returns the prior over the legal moves given their policy indices. Renormalising the
+    policy over the legal indices is the softmax of the logits restricted to those moves.
+    """
+    priors = np.asarray(p_evaluated)[indices].astype('float64')
+    total = priors.sum()
+    if total <= 0:
+        return np.full(len(indices), 1. / max(len(indices), 1))
+    return priors / total
+
+
+
+def compact_policy(pi_y):
+    """
+    Convert full policy targets, of NUM_CHECKERS * BOARD_WIDTH * BOARD_HEIGHT entries,
+    to the compact encoding over the playable cells. Works on a single target or a batch.
+    """
+    pi_y = np.asarray(pi_y)
+    full = pi_y.reshape(pi_y.shape[:-1] + (NUM_CHECKERS, BOARD_WIDTH * BOARD_HEIGHT))
+    return full[..., STAR_GEOMETRY.flat_cells].reshape(pi_y.shape[:-1] + (-1,))
+
+
+
+def expand_policy(pi_y):
+    """
+    Convert compact policy targets back to the full encoding, with zeros on the off-board cells
+    """
+    pi_y = np.asarray(pi_y)
+    compact = pi_y.reshape(pi_y.shape[:-1] + (NUM_CHECKERS, STAR_GEOMETRY.num_cells))
+    full = np.zeros(pi_y.shape[:-1] + (NUM_CHECKERS, BOARD_WIDTH * BOARD_HEIGHT), dtype=pi_y.dtype)
+    full[..., STAR_GEOMETRY.flat_cells] = compact
+    return full.reshape(pi_y.shape[:-1] + (-1,))
+
+
+
+def match_policy_encoding(pi_y):
+    """
+    Convert stored policy targets to the encoding in use, if they were saved with the other one
+    """
+    pi_y = np.asarray(pi_y)
+    if COMPACT_POLICY and pi_y.shape[-1] == NUM_CHECKERS * BOARD_WIDTH * BOARD_HEIGHT:
+        return compact_policy(pi_y)
+    if not COMPACT_POLICY and pi_y.shape[-1] == NUM_CHECKERS * STAR_GEOMETRY.num_cells:
+        return expand_policy(pi_y)
+    return pi_y
+
+
+
 def softmax(input):
     ''' Compute the softmax (prediction) given input '''
     input = np.copy(input).astype('float64')
@@ -275,3 +470,14 @@ if __name__ == '__main__':
     print()
     print(p1[:, :, 6])
     print(p2[:, :, 6])
+
+    # The batched encoder matches the first channels of to_model_input, with and without history
+    boards = [b.clone()]
+    for move, (origin, dest) in enumerate([((3, 9), (4, 9)), ((4, 7), (5, 7)), ((3, 10), (4, 10))]):
+        b.place(PLAYER_ONE + move % 2, origin, dest)
+        boards.append(b.clone())
+    players = [PLAYER_ONE, PLAYER_TWO] * len(boards)
+    batched = to_model_inputs(boards * 2, players)
+    assert batched.dtype == np.float32 and batched.shape == (len(players),) + INPUT_DIM
+    for board, player, model_input in zip(boards * 2, players, batched):
+        assert np.array_equal(to_model_input(board, player)[:, :, :INPUT_DIM[-1]], model_input)